@@ -6,20 +6,32 @@ in real world, where urllib fails because of hanging sockets"""
 
 import cStringIO
 import hashlib
+import heapq
+import itertools
 import json
 import logging
 import os
 import pycurl
+import random
 import re
+import threading
 import time
+import urlparse
 import zlib
 
+from collections import deque
 from warnings import warn
 
 import lxml
+import lxml.html
 from lxml.html.soupparser import fromstring
 from lxml import etree
 
+from journal import Journal
+from proxies import ProxyPool
+from resolver import Resolver
+from throttle import AdaptiveConcurrency, RateLimiter
+
 
 class ConnectionsNumberWarning(UserWarning):
     """Number of connections is too big"""
@@ -31,6 +43,11 @@ class UrlTooLongWarning(UserWarning):
     pass
 
 
+class Http2Warning(UserWarning):
+    """libcurl is built without HTTP/2 support"""
+    pass
+
+
 class ConnectionsNumberException(Exception):
     """Minimum 1 connection required"""
     pass
@@ -41,6 +58,126 @@ class CacheConfigurationException(Exception):
     pass
 
 
+# curl error codes grouped by reason, used by RetryPolicy 'errors' option
+RETRY_ERRORS = {
+    "timeout": (pycurl.E_OPERATION_TIMEOUTED,),
+    "connect": (pycurl.E_COULDNT_CONNECT,),
+    "reset": (pycurl.E_GOT_NOTHING, pycurl.E_SEND_ERROR,
+              pycurl.E_RECV_ERROR),
+    "dns": (pycurl.E_COULDNT_RESOLVE_HOST,),
+}
+
+
+# Methods which can be safely repeated, server may have processed request
+# of other method before transfer failed
+IDEMPOTENT_METHODS = ("GET", "HEAD")
+
+
+class RetryPolicy(object):
+    """Describes when and how often failed transfer should be retried by
+    multi_fetch.
+
+    attempts - total number of attempts, including the first one
+
+    backoff - delay in seconds before first retry, it's doubled for every
+    next attempt but never exceeds 'max_backoff'
+
+    jitter - fraction of delay which is randomly added or subtracted, so
+    retries of many failed urls don't hit server at the same moment
+
+    errors - list of RETRY_ERRORS keys which should be retried
+
+    codes - list of HTTP status codes which should be retried
+
+    methods - request methods which are retried, POST and others are not
+    retried by default, since server may have already processed them
+    """
+    def __init__(self, attempts=3, backoff=1.0, max_backoff=60.0, jitter=0.5,
+                 errors=("timeout", "connect", "reset"),
+                 codes=(500, 502, 503, 504), methods=IDEMPOTENT_METHODS):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.errors = errors
+        self.codes = codes
+        self.methods = methods
+
+    def should_retry(self, attempt, errno=None, code=None, method="GET"):
+        """Check if request which failed on 'attempt' should be repeated"""
+        if attempt >= self.attempts or method not in self.methods:
+            return False
+
+        if errno is not None:
+            for reason in self.errors:
+                if errno in RETRY_ERRORS.get(reason, ()):
+                    return True
+            return False
+
+        return code in self.codes
+
+    def delay(self, attempt):
+        """Time in seconds to wait before next attempt"""
+        delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+        return max(0, delay * (1 + random.uniform(-self.jitter, self.jitter)))
+
+
+class TransferFilter(object):
+    """Rules checked by multi_fetch while response headers arrive, transfer
+    is aborted as soon as it breaks any of them and 'skipped' result is
+    returned, so unwanted bodies are not downloaded.
+
+    content_types - accepted media types or their prefixes, like
+    ("text/html", "application/xhtml"), responses without Content-Type
+    are accepted
+
+    codes - accepted HTTP status codes, skipped responses are not retried
+
+    max_length - maximum body size in bytes, checked against Content-Length
+    and against bytes actually received, so it works when server doesn't
+    send Content-Length (unlike 'max_size')
+
+    Headers of redirects followed by curl are not checked
+    """
+    def __init__(self, content_types=None, codes=None, max_length=None):
+        self.content_types = content_types
+        self.codes = codes
+        self.max_length = max_length
+
+    def check_code(self, code):
+        """Return reason to skip response with status 'code' or None"""
+        if self.codes is not None and code not in self.codes:
+            return "code %s" % code
+
+        return None
+
+    def check_header(self, name, value):
+        """Return reason to skip response with given header or None"""
+        name = name.lower()
+
+        if name == "content-type" and self.content_types is not None:
+            media_type = value.split(";", 1)[0].strip().lower()
+            for accepted in self.content_types:
+                if media_type.startswith(accepted):
+                    return None
+            return "content type %s" % media_type
+
+        if name == "content-length" and self.max_length is not None:
+            try:
+                return self.check_size(int(value))
+            except ValueError:
+                return None
+
+        return None
+
+    def check_size(self, size):
+        """Return reason to skip response of 'size' bytes or None"""
+        if self.max_length is not None and size > self.max_length:
+            return "length %s" % size
+
+        return None
+
+
 class Struct:
     """
     http://stackoverflow.com/questions/1305532/convert-python-dict-to-object
@@ -61,7 +198,9 @@ class Browser(object):
     consuption.
 
     You will need to recompile libcurl with c-ares support if you want
-    to get maximum perfomance when doing mass fetch.
+    to get maximum perfomance when doing mass fetch, or enable
+    'pre_resolve' to resolve every host of the batch concurrently before
+    fetching.
 
 
     Any gzip data will be returned uncompressed
@@ -141,22 +280,582 @@ class Browser(object):
         self.transfer_timeout = kwargs.get("transfer_timeout", 10)
 
         # Path to a file where cookies will be stored, by default
-        # cookies are disabled
+        # cookies are disabled. Cookies are kept in memory and shared by
+        # all requests, file is read once and written after every fetch
+        # and multi_fetch call
         self.cookies_file = kwargs.get("cookies_file", None)
 
+        # Write cookies to 'cookies_file' every 'cookies_flush_interval'
+        # seconds during long multi_fetch, so they survive crash
+        self.cookies_flush_interval = kwargs.get("cookies_flush_interval",
+                                                 None)
+
         # Should Browser follow server redirects, defaults to True,
         # as any real-life browser, but may be useful to disable it
         # if you need to get data from redirect page (some websites do this)
         self.follow_redirects = kwargs.get("follow_redirects", True)
 
+        # Use HTTP/2 for https urls and multiplex requests to the same host
+        # over few connections in multi_fetch, requires libcurl built with
+        # nghttp2. Set to "prior_knowledge" to use HTTP/2 for plain http
+        # urls as well (without upgrade, server must support it)
+        self.http2 = kwargs.get("http2", False)
+
+        if self.http2 and \
+           not pycurl.version_info()[4] & getattr(pycurl, "VERSION_HTTP2", 0):
+            warn("libcurl doesn't support HTTP/2, using HTTP/1.1",
+                 Http2Warning)
+            self.http2 = False
+
+        # With HTTP/2 enabled, limit connections to one host and requests
+        # (streams) sent over one connection, None leaves libcurl defaults
+        self.max_host_connections = kwargs.get("max_host_connections", None)
+        self.max_concurrent_streams = kwargs.get("max_concurrent_streams",
+                                                 None)
+
         # Drop connection if server tries to return more than 'max_size'
         # bytes, default to 1mb which is more than enough for most pages
         self.max_size = kwargs.get("max_size", 1024 * 1024)
 
+        # RetryPolicy instance (or dict of it's arguments) used by
+        # multi_fetch to repeat failed transfers, retries are disabled
+        # by default. Every url entry may override it with own "retry" key
+        self.retry = self.__get_retry_policy(kwargs.get("retry", None))
+
+        # TransferFilter instance (or dict of it's arguments) used by
+        # multi_fetch to abort transfers by status code, content type or
+        # size before body is downloaded. Every url entry may override it
+        # with own "filter" key
+        self.transfer_filter = self.__get_transfer_filter(
+            kwargs.get("transfer_filter", None))
+
+        # Parse pages in multi_fetch while they are downloaded, result
+        # 'tree' gets lxml.html root element and 'data' is None, set to
+        # "keep_data" to get both. Data is always kept when caching is on.
+        # Every url entry may override it with own "parse" key
+        self.parse_html = kwargs.get("parse_html", False)
+
+        # RateLimiter instance (or dict of it's arguments) to limit requests
+        # and bytes per second globally and per host in multi_fetch,
+        # 'num_conn' only limits number of simultaneous connections
+        rate_limit = kwargs.get("rate_limit", None)
+        if isinstance(rate_limit, dict):
+            rate_limit = RateLimiter(**rate_limit)
+        self.rate_limit = rate_limit
+
+        # AdaptiveConcurrency instance (or dict of it's arguments, or True
+        # for defaults) to let multi_fetch pick number of connections by
+        # itself, 'num_conn' becomes upper limit. Current window size is
+        # available as browser.adaptive_concurrency.window
+        adaptive = kwargs.get("adaptive_concurrency", None)
+        if adaptive is True:
+            adaptive = AdaptiveConcurrency()
+        elif isinstance(adaptive, dict):
+            adaptive = AdaptiveConcurrency(**adaptive)
+        self.adaptive_concurrency = adaptive
+
+        # All curl handles share DNS cache, TLS sessions and cookies, so
+        # every host is resolved and TLS handshake is fully done only once.
+        # Requests with 'session' get separate share with own cookies,
+        # which are stored in 'cookies_file' + "." + session
+        self.__shares = dict()
+        self.__shares_lock = threading.Lock()
+        self.share = self.__get_share(None)
+
+        # Resolver instance (or dict of it's arguments, or True for
+        # defaults) to resolve all hosts of multi_fetch batch concurrently
+        # before fetching. Urls of hosts that don't exist get error result
+        # right away instead of taking connection until timeout. Requests
+        # read while transfers are running are resolved in background
+        resolver = kwargs.get("pre_resolve", None)
+        if resolver is True:
+            resolver = Resolver()
+        elif isinstance(resolver, dict):
+            resolver = Resolver(**resolver)
+        self.resolver = resolver
+
+        # ProxyPool instance (or dict of it's arguments, or list of proxy
+        # urls) to send requests through. Proxy is picked for every
+        # transfer, requests which failed because of proxy are repeated
+        # through other one and failing proxies rest for a while
+        proxies = kwargs.get("proxies", None)
+        if isinstance(proxies, dict):
+            proxies = ProxyPool(**proxies)
+        elif isinstance(proxies, (list, tuple)):
+            proxies = ProxyPool(proxies)
+        self.proxies = proxies
+
+        # Requests performed by fetch() right now, so concurrent calls from
+        # different threads for the same url share one transfer
+        self.__inflight = dict()
+        self.__inflight_lock = threading.Lock()
+
         self.logger = logging.getLogger("Browser")
         self.logger.debug("PycURL %s (compiled against 0x%x)" %
                           (pycurl.version, pycurl.COMPILE_LIBCURL_VERSION_NUM))
 
+    def __get_retry_policy(self, policy):
+        """Convert retry configuration to RetryPolicy instance"""
+        if isinstance(policy, dict):
+            return RetryPolicy(**policy)
+
+        return policy or None
+
+    def __get_transfer_filter(self, rules):
+        """Convert filter configuration to TransferFilter instance"""
+        if isinstance(rules, dict):
+            return TransferFilter(**rules)
+
+        return rules or None
+
+    def __transfer_callbacks(self, curl, rules, parse):
+        """Make header and write callbacks for transfer. Transfer breaking
+        'rules' is aborted and reason is saved to curl.skipped. When 'parse'
+        is set, body is decompressed and fed to curl.parser as it arrives,
+        it's kept in curl.res only when 'parse' is "keep_data"
+        """
+        # Status of response being received, headers of redirects which
+        # will be followed and of "100 Continue" are not checked
+        state = {"final": True, "size": 0, "gzip": False, "charset": None}
+
+        def skip(reason):
+            """Remember reason and abort transfer"""
+            curl.skipped = reason
+            return 0
+
+        def on_header(line):
+            """Check status line and headers"""
+            curl.headers.write(line)
+            reason = None
+
+            if line.startswith("HTTP/"):
+                try:
+                    code = int(line.split()[1])
+                except (IndexError, ValueError):
+                    return None
+
+                state["final"] = not (100 <= code < 200 or
+                    (self.follow_redirects and
+                     code in (301, 302, 303, 307, 308)))
+                state["gzip"] = False
+                state["charset"] = None
+
+                if rules and state["final"]:
+                    reason = rules.check_code(code)
+
+            elif ":" in line and state["final"]:
+                name, value = [part.strip() for part in line.split(":", 1)]
+
+                if name.lower() == "content-encoding":
+                    state["gzip"] = value.lower() == "gzip"
+                elif name.lower() == "content-type":
+                    state["charset"] = self.__get_charset(value)
+
+                if rules:
+                    reason = rules.check_header(name, value)
+
+            return skip(reason) if reason else None
+
+        def feed(chunk):
+            """Decompress chunk and pass it to HTML parser"""
+            if curl.parser is None:
+                curl.parser = self.__make_parser(state["charset"])
+
+                if state["gzip"]:
+                    curl.decompressor = zlib.decompressobj(15 + 32)
+
+            if curl.decompressor:
+                try:
+                    chunk = curl.decompressor.decompress(chunk)
+                except zlib.error:
+                    # Sometimes server can report gzip but send plain text
+                    self.logger.exception("gzip decompression error")
+                    curl.decompressor = None
+
+            if chunk:
+                curl.parser.feed(chunk)
+                if parse == "keep_data":
+                    curl.res.write(chunk)
+
+        def on_write(chunk):
+            """Count received bytes and store or parse them"""
+            if rules:
+                state["size"] += len(chunk)
+                reason = rules.check_size(state["size"])
+                if reason:
+                    return skip(reason)
+
+            if parse:
+                feed(chunk)
+            else:
+                curl.res.write(chunk)
+
+            return None
+
+        return on_header, on_write
+
+    def __finish_parse(self, curl, parse):
+        """Feed rest of decompressed data and return parsed tree"""
+        if curl.parser is None:
+            return None
+
+        rest = curl.decompressor and curl.decompressor.flush()
+        if rest:
+            curl.parser.feed(rest)
+            if parse == "keep_data":
+                curl.res.write(rest)
+
+        try:
+            return curl.parser.close()
+        except etree.LxmlError:
+            self.logger.exception("Couldn't parse %s" % curl.url)
+            return None
+
+    def __get_charset(self, content_type):
+        """Charset declared in Content-Type header value, None if not set"""
+        match = content_type and \
+            re.search(r"charset=[\"']?([\w.:-]+)", content_type, re.I)
+        return str(match.group(1)) if match else None
+
+    def __make_parser(self, charset):
+        """HTML parser decoding page from charset, or guessing it when
+        charset is not set or unknown"""
+        try:
+            return lxml.html.HTMLParser(encoding=charset)
+        except LookupError:
+            return lxml.html.HTMLParser()
+
+    def __parse_html(self, data, content_type=None):
+        """Parse whole page with the same parser used while downloading"""
+        try:
+            return etree.fromstring(data, self.__make_parser(
+                self.__get_charset(content_type)))
+        except etree.LxmlError:
+            self.logger.exception("Couldn't parse page")
+            return None
+
+    def __schedule_retry(self, timers, task, errno=None, code=None):
+        """Put task to timers heap if it's allowed to be retried"""
+        if not task.retry or \
+           not task.retry.should_retry(task.attempt, errno, code,
+                                       task.method):
+            return False
+
+        delay = task.retry.delay(task.attempt)
+        self.logger.debug("Retrying %s in %.2f seconds" % (task.url, delay))
+        heapq.heappush(timers, (time.time() + delay, id(task), task))
+
+        return True
+
+    def __start_transfer(self, mcurl, curl, task, proxy=None):
+        """Set request options on free curl handle and add it to multi"""
+        url_data = task.entry
+
+        try:
+            url = str(task.url)
+        except UnicodeEncodeError:
+            # IDNA url, need to encode it
+            url = str(task.url.encode("idna"))
+
+        curl.setopt(pycurl.URL, url)
+
+        # Handles are reused, so every request option is set each time.
+        # POST without params is sent with empty body, not turned to GET
+        if task.body is not None or task.method == "POST":
+            curl.setopt(pycurl.POSTFIELDS, task.body or "")
+        else:
+            curl.setopt(pycurl.HTTPGET, 1)
+
+        curl.setopt(pycurl.NOBODY, task.method == "HEAD")
+
+        if task.method in ("GET", "POST", "HEAD"):
+            curl.unsetopt(pycurl.CUSTOMREQUEST)
+        else:
+            curl.setopt(pycurl.CUSTOMREQUEST, task.method)
+
+        headers = url_data.get("headers", None) or []
+        if isinstance(headers, dict):
+            headers = ["%s: %s" % item for item in headers.items()]
+        curl.setopt(pycurl.HTTPHEADER, curl.base_headers + list(headers))
+
+        session = url_data.get("session", None)
+        self.__set_share(curl, self.__get_share(session))
+        if session is not None:
+            curl.setopt(pycurl.COOKIEFILE, "")
+
+        # Pin address found by pre resolution
+        if task.address:
+            parsed = urlparse.urlparse(url)
+            port = parsed.port or (443 if parsed.scheme == "https" else 80)
+            curl.setopt(pycurl.RESOLVE, ["%s:%s:%s" % (parsed.hostname, port,
+                                                       task.address)])
+
+        curl.res = cStringIO.StringIO()
+        curl.headers = cStringIO.StringIO()
+        curl.skipped = None
+        curl.parser = curl.decompressor = None
+
+        if task.filter or task.parse:
+            on_header, on_write = self.__transfer_callbacks(curl, task.filter,
+                                                            task.parse)
+            curl.setopt(pycurl.WRITEFUNCTION, on_write)
+            curl.setopt(pycurl.HEADERFUNCTION, on_header)
+        else:
+            curl.setopt(pycurl.WRITEFUNCTION, curl.res.write)
+            curl.setopt(pycurl.HEADERFUNCTION, curl.headers.write)
+
+        if url_data.get("ref", None):
+            curl.setopt(pycurl.REFERER, url_data["ref"])
+
+        if proxy:
+            curl.setopt(pycurl.PROXY, proxy.url)
+
+        mcurl.add_handle(curl)
+
+        curl.url = url
+        curl.task = task
+        curl.started = time.time()
+        curl.hedge = task.hedged
+        curl.id = task.ids[0]
+        curl.proxy = proxy
+        task.copies.append(curl)
+
+    def __hedge_transfers(self, mcurl, freelist, hedge_after, inflight,
+                          limiter, host_limit):
+        """Start second copy of every transfer running longer than
+        'hedge_after' seconds, return time of next check"""
+        now = time.time()
+        wakeup = None
+
+        for curl in mcurl.handles:
+            task = curl.task
+            if task is None or task.hedged or \
+               task.method not in IDEMPOTENT_METHODS:
+                continue
+
+            started = now - hedge_after
+            if curl.started > started:
+                wakeup = min(wakeup or now + hedge_after,
+                             curl.started + hedge_after)
+                continue
+
+            if not freelist or \
+               (limiter and limiter.delay(task.host, now) > 0) or \
+               inflight[task.host] >= host_limit(task.host):
+                continue
+
+            # Copy goes through other proxy when possible
+            proxy = None
+            if self.proxies:
+                proxy = self.proxies.acquire(curl.proxy, now)
+                if proxy is None:
+                    continue
+
+            self.logger.debug("Hedging slow transfer of %s" % task.url)
+
+            if limiter:
+                limiter.consume(task.host, now)
+
+            task.hedged = True
+            inflight[task.host] += 1
+            self.__start_transfer(mcurl, freelist.pop(), task, proxy)
+
+        return wakeup
+
+    def __read_requests(self, entries, pending, journal=None):
+        """Turn url entries to fetch tasks, return list of new tasks and
+        list of results known without fetching (cached and invalid urls).
+        Entries finished according to journal are skipped"""
+        tasks = list()
+        results = list()
+        known = dict()
+
+        for entry in entries:
+            url = entry["url"]
+            uid = entry.get("id", None)
+
+            if not url or url[0] == "#":
+                continue
+
+            method = entry.get("method", "GET").upper()
+            params = entry.get("params", None)
+            body = entry.get("body", None)
+
+            if params:
+                if method in ("GET", "HEAD"):
+                    url = url.strip() + "?" + self.__encode_params(params)
+                elif body is None:
+                    body = self.__encode_params(params)
+
+            key = (method, url, body, entry.get("session", None))
+
+            if journal and journal.is_finished(uid, key):
+                continue
+
+            if key in known:
+                known[key].ids.append(uid)
+                continue
+
+            if key in pending:
+                pending[key].ids.append(uid)
+                continue
+
+            if len(url) > 1024:
+                warn("URLs longer than 1024 characters are ignored",
+                     UrlTooLongWarning)
+
+                known[key] = Struct(**{'result': 'error',
+                                       'key': key,
+                                       'url': url,
+                                       'method': method,
+                                       'id': uid,
+                                       'ids': [uid]})
+                results.append(known[key])
+                continue
+
+            result = self.__load_cached_response(url, method, uid, body)
+            if result:
+                result.ids = [uid]
+                result.key = key
+                if entry.get("parse", self.parse_html):
+                    result.tree = self.__parse_html(result.data,
+                                                    result.content_type)
+                known[key] = result
+                results.append(result)
+                continue
+
+            retry = self.__get_retry_policy(entry.get("retry", self.retry))
+            rules = self.__get_transfer_filter(entry.get("filter",
+                                                         self.transfer_filter))
+
+            parse = entry.get("parse", self.parse_html)
+            if parse and self.cache_method != "never":
+                parse = "keep_data"
+            task = Struct(entry=entry, url=url, key=key, ids=[uid], attempt=0,
+                          method=method, body=body, retry=retry, filter=rules,
+                          parse=parse, proxy=None, proxy_attempts=0,
+                          host=urlparse.urlparse(url).hostname or "",
+                          address=None, copies=[], hedged=False)
+
+            pending[key] = task
+            tasks.append(task)
+
+        duplicates = sum(len(task.ids) for task in tasks) - len(tasks)
+        if duplicates:
+            self.logger.debug("%s duplicate URLs skipped" % duplicates)
+
+        return tasks, results
+
+    def __pre_resolve(self, tasks, pending, addresses):
+        """Pin resolved addresses to tasks, return list of tasks left and
+        list of error results for unknown hosts"""
+        left = list()
+        results = list()
+
+        for task in tasks:
+            if task.host in addresses and addresses[task.host] is None:
+                self.logger.debug("Host %s not found" % task.host)
+                del pending[task.key]
+                results.append(Struct(**{'result': 'error',
+                    'error': "%s Couldn't resolve host '%s'" %
+                             (pycurl.E_COULDNT_RESOLVE_HOST, task.host),
+                    'source': 'web',
+                    'id': task.ids[0],
+                    'ids': task.ids,
+                    'key': task.key,
+                    'url': task.url,
+                    'method': task.method,
+                    'data': None,
+                    'code': None,
+                    'content_type': None,
+                    'attempts': 0,
+                    'hedged': False}))
+                continue
+
+            task.address = addresses.get(task.host, None)
+            left.append(task)
+
+        return left, results
+
+    def __get_cookies_filename(self, session):
+        """File where cookies of session are stored"""
+        if not self.cookies_file:
+            return None
+
+        if session is None:
+            return self.cookies_file
+
+        return "%s.%s" % (self.cookies_file, session)
+
+    def __set_share(self, curl, share):
+        """Attach handle to share, curl refuses to switch shares without
+        detaching from previous one first"""
+        if curl.shared is share:
+            return
+
+        if curl.shared is not None:
+            curl.setopt(pycurl.SHARE, None)
+
+        curl.setopt(pycurl.SHARE, share)
+        curl.shared = share
+
+    def __get_share(self, session):
+        """Get share handle of session, create it and load it's cookies
+        when used for the first time"""
+        with self.__shares_lock:
+            if session in self.__shares:
+                return self.__shares[session].share
+
+            share = pycurl.CurlShare()
+            share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+            share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+
+            # Share with cookies enables them for every attached handle
+            cookies = None
+            if self.cookies_file or session is not None:
+                share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_COOKIE)
+
+                # Handle used only to access cookies kept by share
+                cookies = pycurl.Curl()
+                cookies.setopt(pycurl.SHARE, share)
+
+                filename = self.__get_cookies_filename(session)
+                if filename and os.path.exists(filename):
+                    for line in open(filename):
+                        line = line.strip()
+                        if line and (not line.startswith("#") or
+                                     line.startswith("#HttpOnly_")):
+                            cookies.setopt(pycurl.COOKIELIST, line)
+
+            self.__shares[session] = Struct(share=share, cookies=cookies)
+
+            return share
+
+    def flush_cookies(self, *sessions):
+        """Write cookies kept in memory to 'cookies_file', only cookies of
+        given sessions are written if any passed"""
+        if not self.cookies_file:
+            return
+
+        with self.__shares_lock:
+            for session, entry in self.__shares.items():
+                if entry.cookies is None or \
+                   (sessions and session not in sessions):
+                    continue
+
+                filename = self.__get_cookies_filename(session)
+                lines = entry.cookies.getinfo(pycurl.INFO_COOKIELIST)
+
+                # Write to temporary file first, so crash in the middle
+                # doesn't leave broken cookies file
+                cookies_file = open(filename + ".tmp", "w")
+                cookies_file.write("# Netscape HTTP Cookie File\n")
+                for line in lines:
+                    cookies_file.write(line + "\n")
+                cookies_file.close()
+
+                os.rename(filename + ".tmp", filename)
+
     def __curl_init(self, curl):
         """Inialize curl object and set settings"""
         #self.curl = pycurl.Curl()
@@ -171,15 +870,18 @@ class Browser(object):
         # Required for mass fetch
         curl.setopt(pycurl.NOSIGNAL, 1)
 
+        curl.shared = None
+        self.__set_share(curl, self.share)
+
+        # Enable cookies engine, actual cookies are kept by share
+        if self.cookies_file:
+            curl.setopt(pycurl.COOKIEFILE, "")
+
         # USe IPv4 for now, it's faster and safer for time being
         curl.setopt(pycurl.IPRESOLVE, pycurl.IPRESOLVE_V4)
 
         curl.setopt(pycurl.USERAGENT, self.user_agent)
 
-        if self.cookies_file:
-            curl.setopt(pycurl.COOKIEFILE, self.cookies_file)
-            curl.setopt(pycurl.COOKIEJAR, self.cookies_file)
-
         accept = "Accept: text/html,application/xhtml+xml"\
         ",application/xml;q=0.9,*/*;q=0.8"
 
@@ -188,10 +890,25 @@ class Browser(object):
         headers.append("Accept-Language: ru-ru,ru;q=0.8,en-us;q=0.5,en;q=0.3")
         headers.append("Accept-Encoding: gzip,deflate")
         headers.append("Accept-Charset: utf-8, windows-1251;q=0.7,*;q=0.7")
-        headers.append("Keep-Alive: 115")
-        headers.append("Connection: keep-alive")
+
+        if self.http2:
+            if self.http2 == "prior_knowledge":
+                curl.setopt(pycurl.HTTP_VERSION,
+                            pycurl.CURL_HTTP_VERSION_2_PRIOR_KNOWLEDGE)
+            else:
+                curl.setopt(pycurl.HTTP_VERSION,
+                            pycurl.CURL_HTTP_VERSION_2TLS)
+
+            # Wait for existing connection to multiplex request instead
+            # of opening a new one
+            curl.setopt(pycurl.PIPEWAIT, 1)
+        else:
+            # Connection headers are not allowed in HTTP/2
+            headers.append("Keep-Alive: 115")
+            headers.append("Connection: keep-alive")
 
         curl.setopt(pycurl.HTTPHEADER, headers)
+        curl.base_headers = headers
 
         curl.setopt(pycurl.MAXFILESIZE, self.max_size)
 
@@ -212,19 +929,21 @@ class Browser(object):
 
         return data
 
-    def __get_filename(self, url, method):
-        """Construct filename for cache"""
-        url_hash = hashlib.md5(url).hexdigest()
+    def __get_filename(self, url, method, body=None):
+        """Construct filename for cache, request body is a part of the key,
+        so POST requests with different params are cached separately"""
+        key = url if body is None else url + "\n" + body
+        url_hash = hashlib.md5(key).hexdigest()
         return os.path.join(self.cache_root, url_hash) + "." + method
 
-    def __load_cached_response(self, url, method, uid=None):
+    def __load_cached_response(self, url, method, uid=None, body=None):
         """Save data if caching is enabled"""
 
         if self.cache_method == 'never':
             return None
 
         try:
-            filename = self.__get_filename(url, method)
+            filename = self.__get_filename(url, method, body)
         except:
             return None
 
@@ -250,6 +969,7 @@ class Browser(object):
                        'url': metadata["url"],
                        'code': metadata["code"],
                        'content_type': metadata["content_type"],
+                       'method': method,
                        'id': uid}
 
             return Struct(**result)
@@ -257,12 +977,16 @@ class Browser(object):
         else:
             return None
 
+    def __encode_params(self, params):
+        """Join params dict to query string"""
+        params = ["%s=%s" % (key, value) for key, value in params.items()]
+        return "&".join(params)
+
     def __set_request_params(self, params, url, method, curl):
         """Set params for GET or POST request"""
         url = url.strip()
 
-        params = ["%s=%s" % (key, value) for key, value in params.items()]
-        params_str = "&".join(params)
+        params_str = self.__encode_params(params)
 
         if method == "POST":
             curl.setopt(pycurl.POST, 1)
@@ -275,18 +999,63 @@ class Browser(object):
 
     def fetch(self, url, method="GET", ref=None, **kwargs):
         """Get data of one page by performing GET or POST request, result value
-        is a dict"""
+        is a dict
+
+        If the same request is already performed by another thread, it's
+        result is awaited and returned instead of making new one, so the
+        result object may be shared between callers
+
+        Pass 'session' to use separate set of cookies, for example to work
+        with several accounts on the same site"""
+
+        params = kwargs.get("params", None)
+        key = (method, url, repr(sorted(params.items())) if params else None,
+               kwargs.get("session", None))
+
+        with self.__inflight_lock:
+            waiter = self.__inflight.get(key, None)
+            leader = waiter is None
+            if leader:
+                waiter = Struct(event=threading.Event(), result=None)
+                self.__inflight[key] = waiter
+
+        if not leader:
+            self.logger.debug("Waiting for the same request in progress [%s]"
+                              % url)
+            waiter.event.wait()
+            return waiter.result
+
+        try:
+            waiter.result = self.__fetch(url, method, ref, **kwargs)
+        finally:
+            with self.__inflight_lock:
+                del self.__inflight[key]
+            waiter.event.set()
+
+        return waiter.result
+
+    def __fetch(self, url, method="GET", ref=None, **kwargs):
+        """Perform request for fetch()"""
 
         curl = pycurl.Curl()
         self.__curl_init(curl)
 
+        session = kwargs.get("session", None)
+        if session is not None:
+            self.__set_share(curl, self.__get_share(session))
+            curl.setopt(pycurl.COOKIEFILE, "")
+
         params = kwargs.get("params", None)
+        body = None
         if params:
             url = self.__set_request_params(params, url, method, curl)
 
+            if method == "POST":
+                body = self.__encode_params(params)
+
         self.logger.debug("Fetching single url [%s]" % url)
 
-        result = self.__load_cached_response(url, method)
+        result = self.__load_cached_response(url, method, body=body)
         if result:
             return result
 
@@ -298,14 +1067,48 @@ class Browser(object):
 
         curl.setopt(pycurl.URL, url)
 
-        strbuff = cStringIO.StringIO()
-        curl.setopt(pycurl.WRITEFUNCTION, strbuff.write)
+        proxy = None
+        proxy_attempts = 0
+
+        while True:
+            strbuff = cStringIO.StringIO()
+            curl.setopt(pycurl.WRITEFUNCTION, strbuff.write)
+
+            headers = cStringIO.StringIO()
+            curl.setopt(pycurl.HEADERFUNCTION, headers.write)
 
-        headers = cStringIO.StringIO()
-        curl.setopt(pycurl.HEADERFUNCTION, headers.write)
+            # Request failed because of proxy is repeated through other one
+            if self.proxies:
+                proxy = self.proxies.acquire(proxy, block=True)
+                curl.setopt(pycurl.PROXY, proxy.url)
+
+            error = None
+            try:
+                curl.perform()
+            except pycurl.error, error:
+                pass
+            finally:
+                self.flush_cookies(session)
+
+            if not self.proxies:
+                break
+
+            failed = self.proxies.is_failure(error and error.args[0],
+                curl.getinfo(pycurl.HTTP_CODE),
+                curl.getinfo(pycurl.CONNECT_TIME) > 0)
+            self.proxies.release(proxy, not failed,
+                                 curl.getinfo(pycurl.STARTTRANSFER_TIME))
+
+            if not failed or proxy_attempts >= self.proxies.retries:
+                break
+
+            self.logger.debug("Proxy %s failed for %s" % (proxy.url, url))
+            proxy_attempts += 1
 
         try:
-            curl.perform()
+            if error is not None:
+                raise error
+
             data = self.__normalize_data(strbuff.getvalue(), headers.getvalue())
 
             result = Struct(**{
@@ -318,7 +1121,7 @@ class Browser(object):
                 'method': method,
             })
 
-            result.file = self.__cache_response(result)
+            result.file = self.__cache_response(result, body)
 
             return result
         except pycurl.error:
@@ -332,10 +1135,10 @@ class Browser(object):
             })
 
             
-    def __cache_response(self, data):
+    def __cache_response(self, data, body=None):
         """Save response data and request metadata if caching is enabled"""
         if self.cache_method in ["expire", "forever"]:
-            filename = self.__get_filename(data.url, data.method)
+            filename = self.__get_filename(data.url, data.method, body)
             if data.data:
                 data_file = open(filename, 'w')
                 data_file.write(data.data)
@@ -349,7 +1152,8 @@ class Browser(object):
 
             return filename
 
-    def multi_fetch(self, url_requests, num_conn=100, percentile=100):
+    def multi_fetch(self, url_requests, num_conn=100, percentile=100,
+                    deadline=None, hedge=None, host_conn=None, journal=None):
         """Get no more than 'percentile' % of requested urls,
         limiting simultaneously connections to 'num_conn'
 
@@ -359,6 +1163,22 @@ class Browser(object):
         Set it to lower value (like 90-95) if you care about speed
         and don't care about getting all the urls.
 
+        Set 'deadline' to number of seconds if you need results in fixed
+        time, urls which are not finished by then are returned with
+        'timeout' as their result.
+
+        Set 'hedge' to percentile (like 95) to start duplicate request for
+        every transfer running longer than that percentile of already
+        finished ones, first copy to finish is used and it's result gets
+        'hedged' set to True if it was the duplicate. Only GET and HEAD
+        requests are hedged, others may change something on server.
+
+        Set 'host_conn' to limit simultaneous connections to every host.
+
+        Set 'journal' to Journal instance or path to journal file to record
+        every finished request there and skip requests finished by previous
+        run with the same journal, so crashed run can be resumed.
+
         You need to pass a list of dicts following this structure
 
 
@@ -380,38 +1200,65 @@ class Browser(object):
         your data easely(for example, I pass primary key of my db entry
         so I don't need to maintain url-id associative array)
 
-        Based on http://habrahabr.ru/blogs/personal/61960/"""
+        Duplicate urls are fetched only once, result 'ids' holds every 'id'
+        it was requested with
 
-        queue = []
-        results = dict()
+        Optional 'session' key selects separate set of cookies, see fetch()
 
-        for entry in url_requests:
-            url = entry["url"]
+        Optional 'method' key sets request method ("GET" by default),
+        'params' is a dict put to query string of GET and HEAD requests or
+        to body of others, raw 'body' string may be passed instead, and
+        'headers' is a list or dict of extra headers. Results of requests
+        other than simple GET are returned with (method, url, body) as a key,
+        every result has full request key as 'key'
 
-            if not url or url[0] == "#":
-                continue
+        Optional 'retry' key may hold RetryPolicy (or a dict of it's
+        arguments) for this url only, it overrides Browser 'retry' setting.
+        Only GET and HEAD requests are retried unless policy 'methods' says
+        otherwise.
+        Failed transfers are rescheduled inside the same loop, so waiting for
+        retry never blocks other connections
 
-            if len(url) > 1024:
-                warn("URLs longer than 1024 characters are ignored",
-                     UrlTooLongWarning)
+        Optional 'filter' key may hold TransferFilter (or a dict of it's
+        arguments), overriding Browser 'transfer_filter' setting. Transfers
+        with unwanted status, content type or size are aborted as soon as
+        it's known and returned with 'skipped' result and 'reason'
 
-                results[url] = Struct({'result': 'error'})
-                continue
+        Optional 'parse' key overrides Browser 'parse_html' setting, page is
+        parsed while it's downloaded and result gets lxml tree as 'tree',
+        which can be passed to extract() instead of data
 
-            result = self.__load_cached_response(url, "GET",
-                                                 entry.get("id", None))
-            if result:
-                results[url] = result
-                continue
+        Results are returned as dict with url as a key, use imulti_fetch to
+        get them one by one as soon as they are ready
 
-            queue.append(entry)
+        Based on http://habrahabr.ru/blogs/personal/61960/"""
 
-        # Queue empty
-        if not len(queue):
-            return results
+        results = dict()
+
+        for result in self.imulti_fetch(url_requests, num_conn, percentile,
+                                        deadline, hedge, host_conn,
+                                        journal=journal):
+            if result.key[0] == "GET" and result.key[2] is None:
+                results[result.url] = result
+            else:
+                results[result.key[:3]] = result
 
-        num_urls = len(queue)
-        num_conn = min(num_conn, num_urls)
+        return results
+
+    def imulti_fetch(self, url_requests, num_conn=100, percentile=100,
+                     deadline=None, hedge=None, host_conn=None,
+                     read_ahead=None, journal=None):
+        """Same as multi_fetch, but results are yielded one by one as soon
+        as they are ready.
+
+        'url_requests' can be any iterable, it's read by 'read_ahead'
+        entries when less than 'num_conn' + 'read_ahead' requests are
+        unfinished, everything is read at once by default.
+
+        If 'url_requests' is a collections.deque, it's emptied with
+        popleft() and requests appended to it while iterating are fetched
+        too, so consumer can add new urls (for example, links from the page
+        it just received)"""
 
         if num_conn < 1:
             raise ConnectionsNumberException("""Number of concurent connections
@@ -420,144 +1267,506 @@ class Browser(object):
         # Using 200-300 connections maximum is a good idea, but choose
         # depending on CPU load and network perfomance
         # If you fetch pages from one server, you should limit maximum
-        # connections to 5-10
+        # connections to 5-10, or enable http2 if server supports it
         if num_conn > 1024:
             warn("You should lower number of concurent connections",
                  ConnectionsNumberWarning)
 
-        self.logger.debug("Getting %s URLs using %s connections" %
-                          (num_urls, num_conn))
+        own_journal = isinstance(journal, basestring)
+        if own_journal:
+            journal = Journal(journal)
 
-        mcurl = pycurl.CurlMulti()
-        mcurl.handles = []
-        for _ in range(num_conn):
-            curl = pycurl.Curl()
-            #curl.fp = None
+        if isinstance(url_requests, deque):
+            source = None
+        else:
+            source = iter(url_requests)
+        exhausted = False
 
-            self.__curl_init(curl)
-            mcurl.handles.append(curl)
+        queue = []
+        timers = []
 
-        freelist = mcurl.handles[:]
+        # Tasks which are queued or running, by (url, session), so
+        # duplicate requests are fetched once
+        pending = dict()
+        active = set()
+        num_created = 0
         num_processed = 0
         bailout = 0
 
-        while num_processed < num_urls:
-
-            # Got enough results
-            if bailout:
-                break
-
-            while queue and freelist:
-                url_data = queue.pop(0)
-
-                try:
-                    url = str(url_data["url"])
-                except UnicodeEncodeError:
-                    # IDNA url, need to encode it
-                    url = str(url_data["url"].encode("idna"))
-
-                curl = freelist.pop()
-
-                curl.setopt(pycurl.URL, url)
-                curl.res = cStringIO.StringIO()
-                curl.setopt(pycurl.WRITEFUNCTION, curl.res.write)
-                curl.headers = cStringIO.StringIO()
-                curl.setopt(pycurl.HEADERFUNCTION, curl.headers.write)
-
-                if url_data.get("ref", None):
-                    curl.setopt(pycurl.REFERER, url_data["ref"])
-
-                mcurl.add_handle(curl)
+        mcurl = pycurl.CurlMulti()
+        mcurl.handles = []
 
-                curl.url = url
+        # With multiplexing 'num_conn' limits simultaneous requests, which
+        # share much fewer connections to every host
+        if self.http2:
+            mcurl.setopt(pycurl.M_PIPELINING, pycurl.PIPE_MULTIPLEX)
+
+            if self.max_host_connections:
+                mcurl.setopt(pycurl.M_MAX_HOST_CONNECTIONS,
+                             self.max_host_connections)
+
+            if self.max_concurrent_streams and \
+               hasattr(pycurl, "M_MAX_CONCURRENT_STREAMS"):
+                mcurl.setopt(pycurl.M_MAX_CONCURRENT_STREAMS,
+                             self.max_concurrent_streams)
+
+        freelist = []
+
+        deadline_at = time.time() + deadline if deadline else None
+        cookies_flushed = time.time()
+
+        # Hedging needs some finished transfers to know what is slow, only
+        # recent durations are kept, so percentile follows current
+        # conditions and sorting them stays cheap on long runs
+        durations = deque(maxlen=1000)
+        num_durations = 0
+        hedge_after = None
+        if hedge is True:
+            hedge = 95
+
+        # Tasks of rate limited hosts wait in 'held' until host timer
+        # fires and they are moved to 'ready', so free connections are
+        # given to other hosts meanwhile
+        limiter = self.rate_limit
+        adaptive = self.adaptive_concurrency
+        proxies = self.proxies
+        held = dict()
+        ready = deque()
+        inflight = dict()
+
+        # Read tasks waiting for their hosts to be resolved
+        resolving = []
+
+        def host_limit(host):
+            """Maximum simultaneous connections to host"""
+            limit = host_conn or num_conn
+            if adaptive:
+                limit = min(limit, adaptive.limit(host))
+            return limit
 
-                if id in url_data:
-                    curl.id = url_data["id"]
-                else:
-                    curl.id = None
+        try:
+            while True:
+                # Deque can get new requests every time we yield
+                if source is None:
+                    exhausted = not url_requests
 
-            while 1:
-                ret, _ = mcurl.perform()
-                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                if not active and exhausted:
                     break
 
-            while 1:
-                num_q, ok_list, err_list = mcurl.info_read()
-                for curl in ok_list:
-                    self.logger.debug("Succesfull fetched %s" % curl.url)
-                    mcurl.remove_handle(curl)
-
-                    data = self.__normalize_data(curl.res.getvalue(),
-                                               curl.headers.getvalue())
-
-                    result = Struct(**{
-                       'result': 'ok',
-                       'source': 'web',
-                       'content_type': curl.getinfo(pycurl.CONTENT_TYPE),
-                       'code': curl.getinfo(pycurl.HTTP_CODE),
-                       'data': data,
-                       'id': curl.id,
-                       'url': curl.url,
-                       'method': "GET"
-                    })
-
-                    
-                    result.file = self.__cache_response(result)
-                    
-                    results[curl.url] = result
-
-                    if self.cache_method in ["expire", "forever"]:
+                # Got enough results
+                if bailout:
+                    break
 
-                        data_file = \
-                            open(self.__get_filename(curl.url, "GET"), 'w')
+                if deadline_at and time.time() >= deadline_at:
+                    self.logger.debug("Deadline reached, %s URLs left" %
+                                      len(active))
+                    break
 
-                        data_file.write(data)
-                        data_file.close()
+                # Read more requests when there is not enough work. Every
+                # unfinished task counts, including ones held by host limits
+                # or waiting for retry, so memory stays bounded
+                if not exhausted and \
+                   len(active) < num_conn + (read_ahead or 0):
+                    if source is None:
+                        count = len(url_requests)
+                        if read_ahead:
+                            count = min(count, read_ahead)
+                        entries = [url_requests.popleft()
+                                   for _ in xrange(count)]
+                        exhausted = not url_requests
+                    elif read_ahead:
+                        entries = list(itertools.islice(source, read_ahead))
+                        exhausted = len(entries) < read_ahead
+                    else:
+                        entries = list(source)
+                        exhausted = True
+
+                    tasks, known = self.__read_requests(entries, pending,
+                                                        journal)
+                    active.update(tasks)
+                    num_created += len(tasks)
+
+                    # Hosts are resolved in background, so dead domains
+                    # don't stall running transfers. Nothing can run
+                    # meanwhile when all handles are free, so then it's
+                    # waited for
+                    if self.resolver and tasks:
+                        lookup = self.resolver.resolve_async(
+                            task.host for task in tasks)
+                        if len(freelist) == len(mcurl.handles):
+                            lookup.join()
+                        resolving.append((lookup, tasks))
+                    else:
+                        queue.extend(tasks)
+
+                    for result in known:
+                        if journal:
+                            journal.record(result)
+                        yield result
+
+                    if tasks:
+                        self.logger.debug("Getting %s URLs using %s "
+                                          "connections" %
+                                          (len(tasks), num_conn))
+
+                # Urls of resolved hosts are queued, unknown hosts get error
+                for item in [item for item in resolving
+                             if not item[0].is_alive()]:
+                    resolving.remove(item)
+                    lookup, tasks = item
+
+                    left, failed = self.__pre_resolve(tasks, pending,
+                                                      lookup.addresses or {})
+                    queue.extend(left)
+                    active.difference_update(set(tasks).difference(left))
+                    num_processed += len(failed)
+
+                    for result in failed:
+                        if journal:
+                            journal.record(result)
+                        yield result
+
+                # Failed transfers waiting for retry are kept in timers heap
+                # until their time comes, so they don't occupy connections
+                now = time.time()
+
+                if self.cookies_flush_interval and \
+                   now - cookies_flushed >= self.cookies_flush_interval:
+                    self.flush_cookies()
+                    cookies_flushed = now
+
+                while timers and timers[0][0] <= now:
+                    item = heapq.heappop(timers)[2]
+
+                    if isinstance(item, basestring):
+                        if item in held:
+                            ready.append(held[item].popleft())
+                            if not held[item]:
+                                del held[item]
+                    else:
+                        queue.append(item)
+
+                global_wakeup = 0
+                hedge_wakeup = None
+                proxy_wakeup = None
+                while (ready or queue) and \
+                      (freelist or len(mcurl.handles) < num_conn):
+                    # Global window is full, wait for some transfer to finish
+                    if adaptive and \
+                       len(mcurl.handles) - len(freelist) >= adaptive.limit():
+                        break
 
-                    freelist.append(curl)
+                    if limiter:
+                        delay = limiter.delay(None, now)
+                        if delay > 0:
+                            global_wakeup = now + delay
+                            break
+
+                    released = bool(ready)
+                    task = ready.popleft() if released else queue.pop(0)
+                    host = task.host
+
+                    # Keep order of requests to the same host
+                    if not released and host in held:
+                        held[host].append(task)
+                        continue
+
+                    # Host is released when one of it's transfers finishes
+                    if inflight.get(host, 0) >= host_limit(host):
+                        held.setdefault(host, deque()).appendleft(task)
+                        continue
+
+                    if limiter:
+                        delay = limiter.delay(host, now)
+                        if delay > 0:
+                            held.setdefault(host, deque()).appendleft(task)
+                            heapq.heappush(timers, (now + delay, id(host),
+                                                    host))
+                            continue
+
+                    # Every proxy is busy or resting, wait for some
+                    # transfer to finish or proxy to come back
+                    proxy = None
+                    if proxies:
+                        proxy = proxies.acquire(task.proxy, now)
+                        if proxy is None:
+                            if released:
+                                ready.appendleft(task)
+                            else:
+                                queue.insert(0, task)
+                            proxy_wakeup = proxies.wakeup(now)
+                            break
+
+                    if limiter:
+                        limiter.consume(host, now)
+
+                    if released and host in held:
+                        delay = limiter.delay(host, now) if limiter else 0
+                        heapq.heappush(timers, (now + delay, id(host), host))
+
+                    if freelist:
+                        curl = freelist.pop()
+                    else:
+                        curl = pycurl.Curl()
+                        self.__curl_init(curl)
+                        curl.task = None
+                        mcurl.handles.append(curl)
+
+                    inflight[host] = inflight.get(host, 0) + 1
+                    task.attempt += 1
+                    task.hedged = False
+                    task.proxy = proxy
+                    self.__start_transfer(mcurl, curl, task, proxy)
+
+                # Duplicate transfers which are running longer than most of
+                # finished ones, first copy to finish wins
+                if hedge_after is not None:
+                    hedge_wakeup = self.__hedge_transfers(mcurl, freelist,
+                        hedge_after, inflight, limiter, host_limit)
+
+                while 1:
+                    ret, _ = mcurl.perform()
+                    if ret != pycurl.E_CALL_MULTI_PERFORM:
+                        break
 
-                for curl, errno, errmsg in err_list:
-                    self.logger.debug("Error fetching %s" % curl.url)
-                    curl.fp = None
-                    mcurl.remove_handle(curl)
-                    result = Struct(**{'result': 'error',
+                while 1:
+                    num_q, ok_list, err_list = mcurl.info_read()
+                    finished = [(curl, None, None) for curl in ok_list]
+                    for curl, errno, errmsg in finished + err_list:
+                        # Copy cancelled by other one finished in the same
+                        # batch is already removed and freed
+                        if curl.task is None:
+                            continue
+
+                        curl.fp = None
+                        mcurl.remove_handle(curl)
+                        freelist.append(curl)
+
+                        task = curl.task
+                        task.copies.remove(curl)
+                        curl.task = None
+                        inflight[task.host] -= 1
+                        code = None
+
+                        # Transfer aborted by filter is complete response
+                        skipped = curl.skipped if errno is not None else None
+
+                        if errno is None or skipped:
+                            code = curl.getinfo(pycurl.HTTP_CODE)
+
+                            if limiter:
+                                limiter.charge(task.host,
+                                    curl.getinfo(pycurl.SIZE_DOWNLOAD))
+
+                        if adaptive:
+                            adaptive.record(task.host,
+                                code is not None and code < 500 and
+                                code != 429,
+                                curl.getinfo(pycurl.STARTTRANSFER_TIME),
+                                active=len(mcurl.handles) - len(freelist) + 1,
+                                host_active=inflight[task.host] + 1)
+
+                        proxy_failed = False
+                        if curl.proxy:
+                            proxy_failed = not skipped and \
+                                proxies.is_failure(errno, code,
+                                    curl.getinfo(pycurl.CONNECT_TIME) > 0)
+                            proxies.release(curl.proxy, not proxy_failed,
+                                curl.getinfo(pycurl.STARTTRANSFER_TIME))
+                            task.proxy = curl.proxy
+                            curl.proxy = None
+
+                        if task.host in held:
+                            heapq.heappush(timers,
+                                (time.time(), id(task.host), task.host))
+
+                        # Other copy of hedged transfer may still succeed
+                        if task.copies and not skipped and \
+                           (errno is not None or
+                            (task.retry and code in task.retry.codes)):
+                            continue
+
+                        for other in task.copies:
+                            mcurl.remove_handle(other)
+                            other.task = None
+                            freelist.append(other)
+                            inflight[task.host] -= 1
+                            if other.proxy:
+                                proxies.release(other.proxy)
+                                other.proxy = None
+                        task.copies = []
+
+                        # Repeat right away through other proxy
+                        if proxy_failed and \
+                           task.proxy_attempts < proxies.retries:
+                            self.logger.debug("Proxy %s failed for %s" %
+                                              (task.proxy.url, curl.url))
+                            task.proxy_attempts += 1
+                            queue.insert(0, task)
+                            continue
+
+                        if not skipped and \
+                           self.__schedule_retry(timers, task, errno, code):
+                            continue
+
+                        num_processed += 1
+                        active.discard(task)
+                        del pending[task.key]
+
+                        if skipped:
+                            self.logger.debug("Skipped %s: %s" % (curl.url,
+                                                                  skipped))
+                            result = Struct(**{'result': 'skipped',
+                                'reason': skipped,
+                                'source': 'web',
+                                'content_type':
+                                    curl.getinfo(pycurl.CONTENT_TYPE),
+                                'code': code,
+                                'data': None,
+                                'id': curl.id,
+                                'ids': task.ids,
+                                'key': task.key,
+                                'url': curl.url,
+                                'method': task.method,
+                                'attempts': task.attempt,
+                                'hedged': curl.hedge
+                            })
+
+                            # Not cached, so it can be fetched later with
+                            # different rules
+                            if journal:
+                                journal.record(result)
+                            yield result
+                            continue
+
+                        if errno is not None:
+                            self.logger.debug("Error fetching %s" % curl.url)
+                            result = Struct(**{'result': 'error',
                                             'error': "%s %s" % (errno, errmsg),
                                             'id': curl.id,
+                                            'ids': task.ids,
+                                            'key': task.key,
                                             'url': curl.url,
-                                            'method': 'GET',
+                                            'method': task.method,
                                             'data': None,
                                             'code': None,
-                                            'content_type': None
+                                            'content_type': None,
+                                            'attempts': task.attempt,
+                                            'hedged': curl.hedge
                                             })
 
-                    results[curl.url] = result
-
-                    if self.cache_method in ["expire", "forever"]:
-                        result.file = self.__cache_response(result)
-                        data_file = \
-                            open(self.__get_filename(curl.url, "GET"), 'w')
-
-                        data_file.write("")
-                        data_file.close()
-
-
-                    freelist.append(curl)
-
-                num_processed = num_processed + len(ok_list) + len(err_list)
-
-                if num_urls:
-                    if float(num_processed) / num_urls * 100 > percentile:
-                        bailout = 1
+                            if self.cache_method in ["expire", "forever"]:
+                                result.file = self.__cache_response(result,
+                                                                    task.body)
+                                data_file = open(result.file, 'w')
+
+                                data_file.write("")
+                                data_file.close()
+
+                            if journal:
+                                journal.record(result)
+                            yield result
+                            continue
+
+                        self.logger.debug("Succesfull fetched %s" % curl.url)
+
+                        if task.parse:
+                            tree = self.__finish_parse(curl, task.parse)
+                            data = curl.res.getvalue() \
+                                if task.parse == "keep_data" else None
+                        else:
+                            data = self.__normalize_data(curl.res.getvalue(),
+                                                       curl.headers.getvalue())
+
+                        result = Struct(**{
+                           'result': 'ok',
+                           'source': 'web',
+                           'content_type': curl.getinfo(pycurl.CONTENT_TYPE),
+                           'code': code,
+                           'data': data,
+                           'id': curl.id,
+                           'ids': task.ids,
+                           'key': task.key,
+                           'url': curl.url,
+                           'method': task.method,
+                           'attempts': task.attempt,
+                           'hedged': curl.hedge
+                        })
+
+                        if task.parse:
+                            result.tree = tree
+
+                        result.file = self.__cache_response(result, task.body)
+
+                        if hedge:
+                            durations.append(curl.getinfo(pycurl.TOTAL_TIME))
+                            num_durations += 1
+                            if num_durations >= 20 and \
+                               num_durations % 10 == 0:
+                                ordered = sorted(durations)
+                                hedge_after = ordered[max(0,
+                                    int(len(ordered) * hedge / 100.0) - 1)]
+
+                        if self.cache_method in ["expire", "forever"]:
+
+                            data_file = open(result.file, 'w')
+
+                            data_file.write(data)
+                            data_file.close()
+
+                        if journal:
+                            journal.record(result)
+                        yield result
+
+                    if exhausted and num_created:
+                        if float(num_processed) / num_created * 100 > \
+                           percentile:
+                            bailout = 1
+                            break
+
+                    if not num_q:
                         break
 
-                if not num_q:
-                    break
-
-            mcurl.select(1.0)
-
-        mcurl.close()
-
-        return results
+                # Wake up earlier if some retry is due before select timeout
+                timeout = 1.0
+                if resolving:
+                    timeout = 0.05
+                if timers:
+                    timeout = min(timeout, max(0, timers[0][0] - time.time()))
+                for wakeup in (global_wakeup, hedge_wakeup, proxy_wakeup,
+                               deadline_at):
+                    if wakeup:
+                        timeout = min(timeout, max(0, wakeup - time.time()))
+
+                if active:
+                    mcurl.select(timeout)
+
+            if deadline_at:
+                for task in active:
+                    yield Struct(**{'result': 'timeout',
+                                    'source': 'web',
+                                    'id': task.ids[0],
+                                    'ids': task.ids,
+                                    'key': task.key,
+                                    'url': task.url,
+                                    'method': task.method,
+                                    'data': None,
+                                    'code': None,
+                                    'content_type': None,
+                                    'attempts': task.attempt,
+                                    'hedged': task.hedged})
+
+        finally:
+            # Transfers left by deadline or percentile don't hold proxies
+            for curl in mcurl.handles:
+                if getattr(curl, "proxy", None):
+                    proxies.release(curl.proxy)
+                    curl.proxy = None
+
+            mcurl.close()
+            self.flush_cookies()
+            if own_journal:
+                journal.close()
 
 
     def __get_str(self, element, info):
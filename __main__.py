@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""Command line bulk fetcher, reads requests as JSON lines and writes
+results as soon as they are fetched, so memory usage doesn't depend on
+number of requests.
+
+Every input line is a multi_fetch entry, like
+
+    {"url": "http://python.org/", "id": 2}
+
+Usage:
+
+    python -m curlbrowser requests.jsonl -o results.jsonl
+    python -m curlbrowser requests.jsonl --journal job.journal >> results.jsonl
+    cat requests.jsonl | python -m curlbrowser --format warc > results.warc
+"""
+
+import argparse
+import base64
+import json
+import logging
+import sys
+import time
+import uuid
+
+from curlbrowser import Browser
+
+
+def read_requests(lines, logger):
+    """Parse JSON lines lazily, skipping broken ones"""
+    for num, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            logger.error("Line %s is not valid JSON" % num)
+            continue
+
+        if not isinstance(entry, dict) or not entry.get("url"):
+            logger.error("Line %s has no url" % num)
+            continue
+
+        yield entry
+
+
+def write_jsonl(output, result, with_data):
+    """Write result as one JSON line"""
+    record = dict()
+    for field in ("id", "ids", "url", "method", "result", "source", "code",
+                  "content_type", "attempts", "hedged", "error", "reason"):
+        record[field] = getattr(result, field, None)
+
+    data = getattr(result, "data", None)
+    if with_data and data is not None:
+        try:
+            record["data"] = data.decode("utf-8")
+        except UnicodeDecodeError:
+            record["data"] = base64.b64encode(data)
+            record["encoding"] = "base64"
+
+    output.write(json.dumps(record) + "\n")
+
+
+def to_bytes(value):
+    """Header value as UTF-8 bytes, cached results carry unicode strings
+    read from JSON"""
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+
+def write_warc(output, result, with_data):
+    """Write successful result as WARC response record, body is stored
+    already decompressed, so only basic HTTP headers are recorded"""
+    if result.result != "ok":
+        return
+
+    data = (result.data or "") if with_data else ""
+    http = "HTTP/1.1 %s\r\n" % to_bytes(result.code)
+    if result.content_type:
+        http += "Content-Type: %s\r\n" % to_bytes(result.content_type)
+    http += "Content-Length: %s\r\n\r\n" % len(data)
+    block = http + data
+
+    headers = ["WARC/1.0",
+               "WARC-Type: response",
+               "WARC-Record-ID: <urn:uuid:%s>" % uuid.uuid4(),
+               "WARC-Date: %s" % time.strftime("%Y-%m-%dT%H:%M:%SZ",
+                                               time.gmtime()),
+               "WARC-Target-URI: %s" % to_bytes(result.url),
+               "Content-Type: application/http; msgtype=response",
+               "Content-Length: %s" % len(block)]
+
+    output.write("\r\n".join(headers) + "\r\n\r\n" + block + "\r\n\r\n")
+
+
+def main(argv=None):
+    """Run bulk fetch from command line"""
+    parser = argparse.ArgumentParser(prog="python -m curlbrowser",
+        description="Fetch urls from JSON lines file and stream results")
+    parser.add_argument("input", nargs="?", default="-",
+                        help="requests file, '-' for stdin (default)")
+    parser.add_argument("-o", "--output", default="-",
+                        help="results file, '-' for stdout (default)")
+    parser.add_argument("-f", "--format", choices=("jsonl", "warc"),
+                        default="jsonl")
+    parser.add_argument("-n", "--num-conn", type=int, default=100,
+                        help="simultaneous connections")
+    parser.add_argument("--host-conn", type=int, default=None,
+                        help="simultaneous connections to one host")
+    parser.add_argument("--read-ahead", type=int, default=None,
+                        help="requests read ahead, 10 * num-conn by default")
+    parser.add_argument("--retry", type=int, default=None,
+                        help="attempts for failed requests")
+    parser.add_argument("--host-rate", type=float, default=None,
+                        help="requests per second to one host")
+    parser.add_argument("--content-type", action="append", default=None,
+                        help="accepted content type prefix, others are "
+                             "skipped before download, may be repeated")
+    parser.add_argument("--max-length", type=int, default=None,
+                        help="skip responses bigger than this many bytes")
+    parser.add_argument("--proxy", action="append", default=None,
+                        help="proxy url, may be repeated to use pool")
+    parser.add_argument("--proxy-conn", type=int, default=None,
+                        help="simultaneous connections through one proxy")
+    parser.add_argument("--journal", default=None,
+                        help="journal file to resume interrupted run")
+    parser.add_argument("--no-data", action="store_true",
+                        help="don't write page bodies")
+    parser.add_argument("--cache-method", default="never",
+                        choices=("never", "forever", "expire"))
+    parser.add_argument("--cache-root", default=None)
+    parser.add_argument("--cache-expiration", type=int, default=600)
+    parser.add_argument("--progress", type=float, default=10,
+                        help="seconds between progress reports, 0 disables")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    logger = logging.getLogger("curlbrowser")
+
+    config = {
+        "cache_method": args.cache_method,
+        "cache_root": args.cache_root,
+        "cache_expiration": args.cache_expiration,
+    }
+
+    if args.retry:
+        config["retry"] = {"attempts": args.retry}
+
+    if args.host_rate:
+        config["rate_limit"] = {"host_requests_per_second": args.host_rate}
+
+    if args.content_type or args.max_length:
+        config["transfer_filter"] = {"content_types": args.content_type,
+                                     "max_length": args.max_length}
+
+    if args.proxy:
+        config["proxies"] = {"proxies": args.proxy,
+                             "max_connections": args.proxy_conn}
+
+    browser = Browser(**config)
+
+    source = sys.stdin if args.input == "-" else open(args.input)
+    output = sys.stdout if args.output == "-" else open(args.output, "w")
+    write = write_warc if args.format == "warc" else write_jsonl
+
+    stats = dict()
+    started = reported = time.time()
+
+    def report(now):
+        """Write progress stats to stderr"""
+        done = sum(stats.values())
+        sys.stderr.write("%s done (%s), %.1f/s\n" % (done,
+            ", ".join("%s %s" % item for item in sorted(stats.items())),
+            done / max(now - started, 0.001)))
+
+    results = browser.imulti_fetch(read_requests(source, logger),
+                                   num_conn=args.num_conn,
+                                   host_conn=args.host_conn,
+                                   read_ahead=args.read_ahead or
+                                              args.num_conn * 10,
+                                   journal=args.journal)
+
+    try:
+        for result in results:
+            write(output, result, not args.no_data)
+            stats[result.result] = stats.get(result.result, 0) + 1
+
+            now = time.time()
+            if args.progress and now - reported >= args.progress:
+                reported = now
+                report(now)
+    finally:
+        output.flush()
+        if output is not sys.stdout:
+            output.close()
+
+    if args.progress:
+        report(time.time())
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
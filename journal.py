@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Journal of finished requests, used to resume long multi_fetch runs"""
+
+import json
+import os
+
+
+class Journal(object):
+    """Append-only file with one JSON line for every finished request.
+
+    When journal file already exists, requests it lists are skipped by
+    multi_fetch, so run which crashed can be started again with the same
+    input and only unfinished requests will be fetched. Requests are
+    identified by their 'id', or by method, url, body and session if id is
+    not set.
+
+    retry_errors - fetch requests which failed last time again, only
+    successful and filtered out ones are skipped by default
+
+    Every line is flushed right away, so it survives crash of the process
+    but not necessarily of the whole machine
+    """
+    def __init__(self, path, retry_errors=True):
+        self.path = path
+        self.retry_errors = retry_errors
+        self.finished = set()
+
+        if os.path.exists(path):
+            with open(path, "rb") as journal_file:
+                content = journal_file.read()
+
+            for line in content.splitlines():
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Last line may be written partially before crash
+                    continue
+
+                if record.get("result") in ("ok", "skipped") or \
+                   not retry_errors:
+                    self.finished.add(json.dumps(record["key"]))
+
+            if content and not content.endswith("\n"):
+                # Cut partial line off, otherwise the next record would be
+                # appended to it and lost as well
+                with open(path, "r+b") as journal_file:
+                    journal_file.truncate(content.rfind("\n") + 1)
+
+        self.file = open(path, "a")
+
+    def __make_key(self, uid, key):
+        """Serialize request identity"""
+        return json.dumps(uid if uid is not None else list(key))
+
+    def is_finished(self, uid, key):
+        """Check if request was finished by previous run"""
+        return self.__make_key(uid, key) in self.finished
+
+    def record(self, result):
+        """Append result outcome for every id it was requested with"""
+        for uid in result.ids:
+            self.file.write(json.dumps({
+                "key": uid if uid is not None else list(result.key),
+                "id": uid,
+                "url": result.url,
+                "result": result.result,
+                "code": getattr(result, "code", None)
+            }) + "\n")
+
+        self.file.flush()
+
+    def close(self):
+        """Close journal file"""
+        self.file.close()
@@ -6,6 +6,7 @@ in real world, where urllib fails because of hanging sockets"""
 
 import cStringIO
 import hashlib
+import itertools
 import json
 import logging
 import os
@@ -14,6 +15,7 @@ import re
 import time
 import zlib
 
+from collections import deque
 from warnings import warn
 
 from lxml.html.soupparser import fromstring
@@ -79,6 +81,20 @@ class ListParser(object):
         data = self.browser.fetch(self._construct_url(num))
         return data.data
 
+    def __get_pages(self, nums):
+        """Get data of several pages at once, it's returned in the same
+        order as 'nums', None is returned for pages which failed"""
+        urls = [{"url": self._construct_url(num), "id": num} for num in nums]
+        entries = self.browser.multi_fetch(urls, num_conn=self.num_conn,
+                                           host_conn=self.host_conn)
+
+        pages = dict()
+        for entry in entries.values():
+            for num in entry.ids:
+                pages[num] = entry.data if entry.result == "ok" else None
+
+        return [pages.get(num, None) for num in nums]
+
     def fetch(self):
         """Get and return data as struct"""
         results = list()
@@ -86,34 +102,31 @@ class ListParser(object):
         data = self.__get_page(1)
         results.extend(self.__extract_page_data(data).items)
 
+        pages = self._get_page_numbers(data)
 
-        if self.count_extractor or self.max_pages:
-            """If we can get maximum number of pages or we have a known last page"""
-            if self.count_extractor:
-                ct = self.__get_page_count(data)
+        if pages is not None:
+            # Every page is fetched at once, unless stop word may end
+            # listing earlier, then pages are fetched by 'num_conn' at once
+            step = self.num_conn if self.stop_word else len(pages)
 
-                self.logger.info("Last page num is %s" % ct)
+            for start in xrange(0, len(pages), max(1, step)):
+                nums = pages[start:start + step]
+                stop = False
 
-                if not ct:
-                    pages = []
-                else:
-                    count = int(ct)
-
-                    if self.max_pages:
-                        pages = xrange(2, max(self.max_pages, count) - 4)
-                    else:
-                        pages = xrange(2, count - 1)
+                for page_num, data in zip(nums, self.__get_pages(nums)):
+                    self.logger.debug("Working on page %s" % page_num)
 
-            else:
-                pages = xrange(2, self.max_pages + 1)
+                    if data is None:
+                        self.logger.error("Couldn't get page %s" % page_num)
+                        continue
 
-            for page_num in pages:
-                self.logger.debug("Working on page %s" % page_num)
-                data = self.__get_page(page_num)
+                    results.extend(self.__extract_page_data(data).items)
 
-                results.extend(self.__extract_page_data(data).items)
+                    if self.stop_word and self.stop_word in data:
+                        stop = True
+                        break
 
-                if self.stop_word and self.stop_word in data:
+                if stop:
                     break
 
         else:
@@ -122,25 +135,76 @@ class ListParser(object):
             if not self.stop_function(data):
                 """First page may be the last. no need to fetch page 2 in this case"""
                 page_num = 2
-                while True:
-                    self.logger.debug("Working on page %s" % page_num)
-                    data = self.__get_page(page_num)
+                stop = False
 
-                    results.extend(self.__extract_page_data(data).items)
+                # Next 'prefetch' pages are fetched at once, pages after
+                # the last one are thrown away
+                step = max(1, self.prefetch)
 
-                    if self.stop_function(data):
-                        break
+                while not stop:
+                    nums = range(page_num, page_num + step)
+
+                    for page_num, data in zip(nums, self.__get_pages(nums)):
+                        self.logger.debug("Working on page %s" % page_num)
+
+                        if data is None:
+                            self.logger.error("Couldn't get page %s" %
+                                              page_num)
+                            stop = True
+                            break
+
+                        results.extend(self.__extract_page_data(data).items)
+
+                        if self.stop_function(data):
+                            stop = True
+                            break
 
                     page_num += 1
 
 
         return results
 
-    def __init__(self, browser, max_pages=None, stop_word=None):
+    def _get_page_numbers(self, data):
+        """Get list of pages after the first one if they are known from
+        count_extractor or max_pages, None is returned when last page can
+        only be found by stop_function"""
+        if not self.count_extractor and not self.max_pages:
+            return None
+
+        """If we can get maximum number of pages or we have a known last page"""
+        if self.count_extractor:
+            ct = self.__get_page_count(data)
+
+            self.logger.info("Last page num is %s" % ct)
+
+            if not ct:
+                pages = []
+            else:
+                count = int(ct)
+
+                if self.max_pages:
+                    pages = xrange(2, max(self.max_pages, count) - 4)
+                else:
+                    pages = xrange(2, count - 1)
+
+        else:
+            pages = xrange(2, self.max_pages + 1)
+
+        return list(pages)
+
+    def __init__(self, browser, max_pages=None, stop_word=None, num_conn=5,
+                 prefetch=0, host_conn=None):
+        """'num_conn' limits simultaneous connections when page count is
+        known, 'prefetch' is a number of pages fetched at once when last
+        page can only be found by stop_function, 'host_conn' limits
+        connections to one host"""
 
         self.browser = browser
         self.max_pages = max_pages
         self.stop_word = stop_word
+        self.num_conn = num_conn
+        self.prefetch = prefetch
+        self.host_conn = host_conn
         self.logger = logging.getLogger("ListParser")
 
 
@@ -155,25 +219,105 @@ class SearchParser(ListParser):
     page_data_extractor = None
 
     def fetch(self):
-        results = super(SearchParser,self).fetch()
+        return list(self.ifetch())
 
-        lresults = list()
-        links = [{"url": link} for link in results]
-        entries = self.browser.multi_fetch(links, num_conn=5)
+    def __add_links(self, requests, data):
+        """Put links from listing page to requests queue"""
+        for link in self.browser.extract(data, self.list_data_extractor).items:
+            requests.append({"url": link})
+
+    def __request_pages(self, requests, pages, waiting, window):
+        """Put next listing pages to requests queue, keeping no more than
+        'window' of them waiting"""
+        while len(waiting) < window:
+            page_num = next(pages, None)
+            if page_num is None:
+                break
+
+            waiting.append(page_num)
+            requests.append({"url": self._construct_url(page_num),
+                             "id": ("page", page_num)})
+
+    def ifetch(self):
+        """Yield data of every linked page as soon as it's extracted.
+
+        Listing pages and linked pages are fetched by one imulti_fetch call,
+        so links are followed while the rest of listing is still loading.
+        Listing pages are processed in their order, so stop_word and
+        stop_function work the same way as in fetch()"""
+
+        data = self.browser.fetch(self._construct_url(1)).data
+
+        requests = deque()
+        self.__add_links(requests, data)
+
+        pages = self._get_page_numbers(data)
+        known = pages is not None
+
+        if known:
+            window = self.num_conn if self.stop_word else len(pages)
+        else:
+            # Last page is unknown, keep 'prefetch' pages requested ahead
+            window = max(1, self.prefetch)
+            pages = [] if self.stop_function(data) else itertools.count(2)
+
+        pages = iter(pages)
+
+        # Listing pages requested and received, but not processed yet
+        waiting = deque()
+        received = dict()
+        stopped = False
+
+        self.__request_pages(requests, pages, waiting, window)
+
+        for entry in self.browser.imulti_fetch(requests, num_conn=self.num_conn,
+                                               host_conn=self.host_conn):
+
+            if isinstance(entry.id, tuple):
+                received[entry.id[1]] = \
+                    entry.data if entry.result == "ok" else None
+
+                while waiting and waiting[0] in received:
+                    page_num = waiting.popleft()
+                    data = received.pop(page_num)
+
+                    if stopped:
+                        continue
+
+                    self.logger.debug("Working on page %s" % page_num)
+
+                    if data is None:
+                        self.logger.error("Couldn't get page %s" % page_num)
+                        stopped = not known
+                        continue
+
+                    self.__add_links(requests, data)
+
+                    if known:
+                        stopped = bool(self.stop_word and
+                                       self.stop_word in data)
+                    else:
+                        stopped = self.stop_function(data)
+
+                if not stopped:
+                    self.__request_pages(requests, pages, waiting, window)
+
+                continue
+
+            if entry.result != "ok":
+                self.logger.error("Couldn't get page %s" % entry.url)
+                continue
 
-        for url, entry in entries.items():
             try:
                 data = self.browser.extract(entry.data,
-                                        self.page_data_extractor)
-                data.link = url
-                lresults.append(data)
+                                            self.page_data_extractor)
+                data.link = entry.url
+                yield data
             except (KeyboardInterrupt, SystemExit):
                 raise
             except etree.XPathEvalError:
                 self.logger.exception("Couldn't exract page data")
 
-        return lresults
-
 class Extractor(object):
     """This class may be extended to provide custom parsing functionality
     You should init it with a dict, where every key is a name of resulting
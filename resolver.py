@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""Concurrent host name resolution used by Browser.multi_fetch to resolve
+every host of the batch before it's urls are fetched"""
+
+import socket
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+
+class Resolver(object):
+    """Resolves many host names at once using pool of threads and caches
+    results, including hosts which don't exist, so dead domains don't
+    occupy connections until connection timeout.
+
+    threads - number of simultaneous lookups
+
+    ttl - seconds to keep resolved address
+
+    negative_ttl - seconds to remember that host doesn't exist
+    """
+
+    # Errors meaning that host name doesn't exist, any other error
+    # (like temporary DNS server failure) is not cached
+    NOT_FOUND = set(getattr(socket, name) for name in
+                    ("EAI_NONAME", "EAI_NODATA") if hasattr(socket, name))
+
+    def __init__(self, threads=50, ttl=300, negative_ttl=600):
+        self.threads = threads
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache = dict()
+        self.lock = threading.Lock()
+
+    def __lookup(self, host):
+        """Resolve single host, return (host, address) where address is
+        None for unknown host and False when lookup failed for other
+        reason"""
+        try:
+            info = socket.getaddrinfo(host, None, socket.AF_INET,
+                                      socket.SOCK_STREAM)
+            return host, info[0][4][0]
+        except socket.gaierror, error:
+            if error.args[0] in self.NOT_FOUND:
+                return host, None
+            return host, False
+        except UnicodeError:
+            return host, False
+
+    def resolve(self, hosts):
+        """Return dict of host -> IPv4 address, or None for hosts which
+        don't exist. Hosts which failed to resolve for other reasons are
+        omitted, so curl can try them by itself"""
+        now = time.time()
+        results = dict()
+        missing = list()
+
+        with self.lock:
+            for host in set(hosts):
+                if host in self.cache and self.cache[host][1] > now:
+                    results[host] = self.cache[host][0]
+                elif host:
+                    missing.append(host)
+
+        if missing:
+            pool = ThreadPool(min(self.threads, len(missing)))
+            try:
+                resolved = pool.map(self.__lookup, missing)
+            finally:
+                pool.close()
+
+            with self.lock:
+                for host, address in resolved:
+                    if address is False:
+                        continue
+
+                    ttl = self.ttl if address else self.negative_ttl
+                    self.cache[host] = (address, now + ttl)
+                    results[host] = address
+
+        return results
+
+    def resolve_async(self, hosts):
+        """Start resolve() in background thread, returned Lookup gets
+        it's result as 'addresses' when thread is finished"""
+        lookup = Lookup(self, hosts)
+        lookup.start()
+        return lookup
+
+
+class Lookup(threading.Thread):
+    """Background resolve() call, 'addresses' stays None if it failed"""
+    def __init__(self, resolver, hosts):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.resolver = resolver
+        self.hosts = list(hosts)
+        self.addresses = None
+
+    def run(self):
+        self.addresses = self.resolver.resolve(self.hosts)
@@ -1,6 +1,25 @@
+import BaseHTTPServer
+import base64
+import json
+import os
+import socket
+import SocketServer
+import tempfile
+import threading
+import time
 import unittest
+import zlib
 
-from curlbrowser import Browser, CacheConfigurationException
+import pycurl
+
+from curlbrowser import Browser, CacheConfigurationException, RetryPolicy, \
+    Struct, TransferFilter
+from curlbrowser.__main__ import main
+from curlbrowser.journal import Journal
+from curlbrowser.parsers import Extractor, ListParser, SearchParser
+from curlbrowser.proxies import ProxyPool
+from curlbrowser.resolver import Resolver
+from curlbrowser.throttle import AdaptiveConcurrency, RateLimiter
 
 class CacheConfigured(unittest.TestCase):
     def runTest(self):
@@ -58,5 +77,860 @@ class FetchMany(unittest.TestCase):
 
         self.assertEqual(len(entries), 3)
         
+
+class StandInSite(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Local site for multi_fetch tests, first part of path selects
+    page_* method, other parts are it's arguments"""
+    protocol_version = "HTTP/1.1"
+    body = ""
+
+    # Response is sent by one write, so kept alive connection doesn't
+    # wait for delayed ACK
+    wbufsize = -1
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.body = self.rfile.read(length)
+        self.do_GET()
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        parts = path.strip("/").split("/")
+
+        with self.server.lock:
+            hits = self.server.hits
+            hits[self.path] = hits.get(self.path, 0) + 1
+
+        page = getattr(self, "page_" + parts[0], None)
+        if page is None:
+            self.respond("not found", 404)
+        else:
+            page(*parts[1:])
+
+    def respond(self, body, code=200, headers=(),
+                content_type="text/html; charset=utf-8", sized=True):
+        """Send response, without Content-Length unless 'sized' is set, so
+        end of body is marked by closed connection"""
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        if sized:
+            self.send_header("Content-Length", str(len(body)))
+        else:
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def page_cookie(self, action, value=None):
+        if action == "set":
+            self.respond("set", headers=[("Set-Cookie",
+                                          "visit=%s; Path=/" % value)])
+        else:
+            self.respond(self.headers.get("Cookie", ""))
+
+    def page_echo(self):
+        self.respond("%s %s" % (self.command, self.body))
+
+    def page_flaky(self, name, failures):
+        """Fails with 503 first 'failures' times"""
+        if self.server.hits[self.path] <= int(failures):
+            self.respond("busy", 503)
+        else:
+            self.respond("ok %s" % name)
+
+    def page_slow(self, seconds):
+        time.sleep(float(seconds))
+        self.respond("slow")
+
+    def page_at(self, when):
+        """Answers at given unix time"""
+        time.sleep(max(0, float(when) - time.time()))
+        self.respond("at")
+
+    def page_stall(self, name):
+        """First request stalls, repeated ones are answered at once"""
+        if self.server.hits[self.path] == 1:
+            time.sleep(3)
+        self.respond("stall %s" % name)
+
+    def page_list(self, total, num):
+        """Listing page with three links, last one says so"""
+        links = ["<a href='http://%s/item/%s/%s'>item</a>" %
+                 (self.headers["Host"], num, item) for item in range(3)]
+        if int(num) >= int(total):
+            links.append("LAST")
+        self.respond("<html><body>%s</body></html>" % "".join(links))
+
+    def page_item(self, num, item):
+        self.respond("<html><body><h1>item %s-%s</h1></body></html>" %
+                     (num, item))
+
+    def page_gzip(self, paragraphs, sized="sized"):
+        """Gzipped windows-1251 page with title and many paragraphs, they
+        differ so compressed body comes in several chunks"""
+        page = u"<html><body><h1>\u043f\u0440\u0438\u0432\u0435\u0442</h1>" \
+            u"%s</body></html>" % u"".join(u"<p>%s</p>" % (num * 7919 % 100003)
+                                           for num in range(int(paragraphs)))
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + 15)
+        body = compressor.compress(page.encode("windows-1251")) + \
+            compressor.flush()
+        self.respond(body, headers=[("Content-Encoding", "gzip")],
+                     content_type="text/html; charset=windows-1251",
+                     sized=sized == "sized")
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded server counting hits of every path"""
+    daemon_threads = True
+
+    # Many connections are opened at once, default backlog drops them
+    request_queue_size = 128
+
+    def __init__(self, handler):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), handler)
+        self.hits = dict()
+        self.lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        """Cancelled transfers drop connections, it's expected"""
+        pass
+
+
+class LocalSiteCase(unittest.TestCase):
+    """Base for tests which need StandInSite running"""
+    def setUp(self):
+        self.server = StandInServer(StandInSite)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.base = "http://127.0.0.1:%s" % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FetchManySessions(LocalSiteCase):
+    def runTest(self):
+        config = {
+            "cache_method": "never",
+            "cookies_file": os.path.join(tempfile.mkdtemp(), "cookies")
+        }
+
+        browser = Browser(**config)
+
+        # Handles are reused between requests with and without session
+        for _ in range(2):
+            entries = browser.multi_fetch([
+                {"url": self.base + "/cookie/set/plain"},
+                {"url": self.base + "/cookie/set/one", "session": "one"}],
+                num_conn=1)
+            self.assertEqual([entry.result for entry in entries.values()],
+                             ["ok", "ok"])
+
+        entries = browser.multi_fetch([
+            {"url": self.base + "/cookie/show?plain"},
+            {"url": self.base + "/cookie/show?one", "session": "one"}],
+            num_conn=1)
+
+        self.assertEqual(entries[self.base + "/cookie/show?plain"].data,
+                         "visit=plain")
+        self.assertEqual(entries[self.base + "/cookie/show?one"].data,
+                         "visit=one")
+
+        data = browser.fetch(self.base + "/cookie/show", session="one")
+        self.assertEqual(data.data, "visit=one")
+        self.assertTrue(os.path.exists(config["cookies_file"] + ".one"))
+
+
+class FetchManyRetry(LocalSiteCase):
+    def runTest(self):
+        config = {
+            "cache_method": "never",
+            "retry": {"attempts": 3, "backoff": 0.05}
+        }
+
+        browser = Browser(**config)
+        recovers = self.base + "/flaky/recovers/2"
+        broken = self.base + "/flaky/broken/5"
+
+        entries = browser.multi_fetch([{"url": recovers}, {"url": broken},
+            {"url": self.base + "/flaky/once/1", "retry": None}])
+
+        self.assertEqual(entries[recovers].code, 200)
+        self.assertEqual(entries[recovers].attempts, 3)
+        self.assertEqual(entries[broken].code, 503)
+        self.assertEqual(entries[broken].attempts, 3)
+        self.assertEqual(self.server.hits["/flaky/broken/5"], 3)
+
+        # Entry may disable retries
+        self.assertEqual(entries[self.base + "/flaky/once/1"].code, 503)
+
+
+class FetchManyDeadline(LocalSiteCase):
+    def runTest(self):
+        browser = Browser(cache_method="never")
+        fast = self.base + "/slow/0"
+        slow = self.base + "/slow/5"
+
+        started = time.time()
+        entries = browser.multi_fetch([{"url": fast}, {"url": slow}],
+                                      deadline=0.5)
+
+        self.assertTrue(time.time() - started < 2)
+        self.assertEqual(entries[fast].result, "ok")
+        self.assertEqual(entries[slow].result, "timeout")
+
+
+class FetchManyHedge(LocalSiteCase):
+    def runTest(self):
+        browser = Browser(cache_method="never")
+        urls = [{"url": "%s/slow/0?%s" % (self.base, num)}
+                for num in range(30)]
+        stalled = self.base + "/stall/one"
+        urls.append({"url": stalled})
+
+        started = time.time()
+        entries = browser.multi_fetch(urls, num_conn=5, hedge=90)
+
+        self.assertTrue(time.time() - started < 2)
+        self.assertEqual(len(entries), 31)
+        self.assertEqual(entries[stalled].result, "ok")
+        self.assertTrue(entries[stalled].hedged)
+        self.assertEqual(self.server.hits["/stall/one"], 2)
+
+
+class FetchManyHedgeSameBatch(LocalSiteCase):
+    def runTest(self):
+        # Both copies of hedged transfer are answered at the same moment,
+        # so they are often reported by the same info_read call
+        for _ in range(3):
+            browser = Browser(cache_method="never")
+            urls = [{"url": "%s/slow/0?%s" % (self.base, num)}
+                    for num in range(25)]
+            urls.append({"url": "%s/at/%s" % (self.base, time.time() + 0.5)})
+
+            entries = browser.multi_fetch(urls, num_conn=5, hedge=90)
+
+            self.assertEqual(len(entries), 26)
+            for entry in entries.values():
+                self.assertEqual(entry.result, "ok")
+
+
+class StallingResolver(Resolver):
+    """Takes a second to find out that 'stall.invalid' doesn't exist"""
+    def resolve(self, hosts):
+        hosts = list(hosts)
+        if "stall.invalid" in hosts:
+            time.sleep(1)
+        return dict((host, None if host == "stall.invalid" else host)
+                    for host in hosts)
+
+
+class FetchManyPreResolve(LocalSiteCase):
+    def runTest(self):
+        browser = Browser(cache_method="never",
+                          pre_resolve=StallingResolver())
+        urls = [{"url": self.base + "/slow/0.2?1"},
+                {"url": self.base + "/slow/0.2?2"},
+                {"url": "http://stall.invalid/"},
+                {"url": self.base + "/slow/0?3"}]
+
+        # Second chunk is resolved while first one is fetched
+        started = time.time()
+        finished = dict()
+        for result in browser.imulti_fetch(urls, num_conn=2, read_ahead=2):
+            finished[result.url] = (result.result, time.time() - started)
+
+        self.assertEqual(finished[self.base + "/slow/0.2?1"][0], "ok")
+        self.assertTrue(finished[self.base + "/slow/0.2?1"][1] < 0.8)
+        self.assertEqual(finished["http://stall.invalid/"][0], "error")
+        self.assertEqual(finished[self.base + "/slow/0?3"][0], "ok")
+
+
+class LocalListing(ListParser):
+    """Listing of StandInSite with 'total' pages"""
+    list_data_extractor = Extractor({
+        "items": {"xpath": "//a/@href", "mode": "multi"}
+    })
+
+    def __init__(self, browser, base, total, **kwargs):
+        super(LocalListing, self).__init__(browser, **kwargs)
+        self.base = base
+        self.total = total
+
+    def _construct_url(self, num):
+        return "%s/list/%s/%s" % (self.base, self.total, num)
+
+    def stop_function(self, data):
+        return "LAST" in data
+
+
+class LocalSearch(SearchParser, LocalListing):
+    """Same listing, following links"""
+    page_data_extractor = Extractor({
+        "title": {"xpath": "//h1/text()"}
+    })
+
+
+class ListParserPages(LocalSiteCase):
+    def expected(self, pages):
+        return ["%s/item/%s/%s" % (self.base, num, item)
+                for num in range(1, pages + 1) for item in range(3)]
+
+    def runTest(self):
+        browser = Browser(cache_method="never")
+
+        # Known page count, pages are fetched concurrently but kept in order
+        parser = LocalListing(browser, self.base, 5, max_pages=5, num_conn=3)
+        self.assertEqual(parser.fetch(), self.expected(5))
+
+        # Last page found by stop_function, prefetched pages after it are
+        # thrown away
+        parser = LocalListing(browser, self.base, 3, prefetch=2)
+        self.assertEqual(parser.fetch(), self.expected(3))
+        self.assertEqual(self.server.hits.get("/list/3/5"), None)
+
+
+class SearchParserPages(LocalSiteCase):
+    def runTest(self):
+        browser = Browser(cache_method="never")
+
+        parser = LocalSearch(browser, self.base, 4, max_pages=4, num_conn=3)
+        titles = sorted(data.title for data in parser.ifetch())
+        self.assertEqual(titles, sorted("item %s-%s" % (num, item)
+                                        for num in range(1, 5)
+                                        for item in range(3)))
+
+        parser = LocalSearch(browser, self.base, 3, prefetch=2)
+        data = parser.fetch()
+        self.assertEqual(len(data), 9)
+        self.assertEqual(set(entry.link for entry in data),
+                         set("%s/item/%s/%s" % (self.base, num, item)
+                             for num in range(1, 4) for item in range(3)))
+
+
+class FetchManyPost(LocalSiteCase):
+    def runTest(self):
+        config = {
+            "cache_method": "forever",
+            "cache_root": tempfile.mkdtemp()
+        }
+
+        url = self.base + "/echo"
+        requests = [{"url": url, "method": "POST", "params": {"q": "one"}},
+                    {"url": url, "method": "POST", "params": {"q": "two"}},
+                    {"url": url, "method": "POST"},
+                    {"url": url}]
+
+        # Requests with different bodies are cached separately
+        for source in ("web", "cache"):
+            entries = Browser(**config).multi_fetch(requests)
+
+            self.assertEqual(entries[("POST", url, "q=one")].data,
+                             "POST q=one")
+            self.assertEqual(entries[("POST", url, "q=two")].data,
+                             "POST q=two")
+            self.assertEqual(entries[("POST", url, None)].data, "POST ")
+            self.assertEqual(entries[url].data, "GET ")
+            for entry in entries.values():
+                self.assertEqual(entry.source, source)
+
+        self.assertEqual(self.server.hits["/echo"], 4)
+
+        # POST is neither retried nor hedged by default
+        browser = Browser(cache_method="never",
+                          retry={"attempts": 3, "backoff": 0.01})
+        flaky = self.base + "/flaky/post/1"
+        stalled = self.base + "/stall/post"
+        urls = [{"url": "%s/slow/0?%s" % (self.base, num)}
+                for num in range(25)]
+        urls.append({"url": flaky, "method": "POST", "body": "x"})
+        urls.append({"url": stalled, "method": "POST", "body": "x"})
+
+        entries = browser.multi_fetch(urls, num_conn=5, hedge=90)
+
+        self.assertEqual(entries[("POST", flaky, "x")].code, 503)
+        self.assertEqual(entries[("POST", flaky, "x")].attempts, 1)
+        self.assertFalse(entries[("POST", stalled, "x")].hedged)
+        self.assertEqual(self.server.hits["/stall/post"], 1)
+
+
+class FetchManyReadAhead(LocalSiteCase):
+    def runTest(self):
+        configs = [({"cache_method": "never"}, {"host_conn": 1}),
+                   ({"cache_method": "never",
+                     "rate_limit": {"host_requests_per_second": 200}}, {})]
+
+        for config, kwargs in configs:
+            browser = Browser(**config)
+            state = {"read": 0, "ahead": 0}
+
+            def requests():
+                for num in range(300):
+                    state["read"] += 1
+                    yield {"url": "%s/slow/0?%s" % (self.base, num)}
+
+            # Requests held by host limits count against read ahead
+            done = 0
+            for result in browser.imulti_fetch(requests(), num_conn=10,
+                                               read_ahead=20, **kwargs):
+                done += 1
+                state["ahead"] = max(state["ahead"], state["read"] - done)
+
+            self.assertEqual(done, 300)
+            self.assertTrue(state["ahead"] <= 10 + 20 * 2)
+
+
+class FetchManyParse(LocalSiteCase):
+    def runTest(self):
+        browser = Browser(cache_method="never")
+        small = self.base + "/gzip/1"
+        large = self.base + "/gzip/20000"
+
+        entries = browser.multi_fetch([
+            {"url": small, "parse": True},
+            {"url": large, "parse": "keep_data"}])
+
+        # Page is decompressed and decoded while it's downloaded
+        for url in (small, large):
+            self.assertEqual(entries[url].result, "ok")
+            self.assertEqual(entries[url].tree.xpath("//h1/text()"),
+                             [u"\u043f\u0440\u0438\u0432\u0435\u0442"])
+
+        self.assertEqual(entries[small].data, None)
+        self.assertEqual(len(entries[large].tree.xpath("//p")), 20000)
+        self.assertTrue(entries[large].data.startswith("<html><body><h1>"))
+        self.assertTrue(entries[large].data.endswith("</body></html>"))
+
+        # Cached page is decoded with charset it was served with
+        browser = Browser(cache_method="forever", cache_root=tempfile.mkdtemp())
+        for source in ("web", "cache"):
+            entries = browser.multi_fetch([{"url": small, "parse": True}])
+            self.assertEqual(entries[small].source, source)
+            self.assertEqual(entries[small].tree.xpath("//h1/text()"),
+                             [u"\u043f\u0440\u0438\u0432\u0435\u0442"])
+
+
+class FetchManyDuplicates(LocalSiteCase):
+    def runTest(self):
+        browser = Browser(cache_method="never")
+        url = self.base + "/slow/0"
+
+        entries = browser.multi_fetch([{"url": url, "id": num}
+                                       for num in range(1, 4)])
+
+        self.assertEqual(entries[url].ids, [1, 2, 3])
+        self.assertEqual(entries[url].id, 1)
+        self.assertEqual(self.server.hits["/slow/0"], 1)
+
+
+class FetchCoalesced(LocalSiteCase):
+    def runTest(self):
+        browser = Browser(cache_method="never")
+        url = self.base + "/slow/0.5"
+        results = []
+
+        def fetch():
+            results.append(browser.fetch(url))
+
+        threads = [threading.Thread(target=fetch) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([data.result for data in results], ["ok"] * 3)
+        self.assertEqual(self.server.hits["/slow/0.5"], 1)
+
+
+class CommandLine(LocalSiteCase):
+    def runTest(self):
+        root = tempfile.mkdtemp()
+        requests = os.path.join(root, "requests.jsonl")
+        with open(requests, "w") as requests_file:
+            requests_file.write(json.dumps({"url": self.base + "/gzip/1",
+                                            "id": 1}) + "\n")
+            requests_file.write(json.dumps({"url": self.base + "/missing",
+                                            "id": 2}) + "\n")
+
+        output = os.path.join(root, "results.jsonl")
+        self.assertEqual(main([requests, "-o", output, "--progress", "0"]), 0)
+
+        with open(output) as output_file:
+            results = [json.loads(line) for line in output_file]
+        results = dict((result["id"], result) for result in results)
+
+        # Page which isn't UTF-8 is written as base64
+        self.assertEqual(sorted(results), [1, 2])
+        self.assertEqual(results[1]["result"], "ok")
+        self.assertEqual(results[1]["encoding"], "base64")
+        page = base64.b64decode(results[1]["data"])
+        self.assertTrue(page.startswith("<html><body><h1>\xef\xf0"))
+        self.assertEqual(results[2]["code"], 404)
+
+        # Second run reads page from cache
+        records = []
+        for _ in range(2):
+            output = os.path.join(root, "results.warc")
+            self.assertEqual(main([requests, "-o", output, "--progress", "0",
+                                   "--format", "warc",
+                                   "--cache-method", "forever",
+                                   "--cache-root", root]), 0)
+            with open(output) as output_file:
+                records.append(output_file.read())
+
+        self.assertEqual(self.server.hits["/gzip/1"], 2)
+        for record in records:
+            self.assertTrue(record.startswith("WARC/1.0\r\n"))
+            self.assertTrue("WARC-Target-URI: %s/gzip/1\r\n" % self.base
+                            in record)
+            self.assertTrue("Content-Type: text/html; charset=windows-1251"
+                            in record)
+            self.assertTrue("\r\n\r\n%s\r\n\r\n" % page in record)
+
+
+class RetryPolicyCheck(unittest.TestCase):
+    def runTest(self):
+        policy = RetryPolicy(attempts=3, backoff=1, max_backoff=3, jitter=0)
+
+        self.assertTrue(policy.should_retry(1, code=503))
+        self.assertFalse(policy.should_retry(1, code=404))
+        self.assertTrue(policy.should_retry(2, errno=pycurl.E_COULDNT_CONNECT))
+        self.assertFalse(policy.should_retry(3, code=503))
+        self.assertFalse(policy.should_retry(1, code=503, method="POST"))
+        self.assertTrue(RetryPolicy(methods=("POST",)).should_retry(1,
+            code=503, method="POST"))
+
+        self.assertEqual(policy.delay(1), 1)
+        self.assertEqual(policy.delay(2), 2)
+        self.assertEqual(policy.delay(5), 3)
+
+
+class RateLimiterCheck(unittest.TestCase):
+    def runTest(self):
+        limiter = RateLimiter(host_requests_per_second=2,
+                              hosts={"slow.com": {"requests_per_second": 1}})
+        now = 1000.0
+
+        self.assertEqual(limiter.delay("fast.com", now), 0)
+        limiter.consume("fast.com", now)
+        self.assertAlmostEqual(limiter.delay("fast.com", now), 0.5)
+
+        limiter.consume("slow.com", now)
+        self.assertAlmostEqual(limiter.delay("slow.com", now), 1)
+
+        # Other hosts and global limit are not affected
+        self.assertEqual(limiter.delay("other.com", now), 0)
+        self.assertEqual(limiter.delay(None, now), 0)
+
+
+class AdaptiveConcurrencyCheck(unittest.TestCase):
+    def runTest(self):
+        adaptive = AdaptiveConcurrency(initial=4, host_initial=2)
+
+        for num in range(40):
+            adaptive.record("example.com", True, 0.1, now=100 + num * 0.2)
+
+        grown = adaptive.window
+        self.assertTrue(grown > 4)
+        self.assertEqual(adaptive.limit("other.com"), 2)
+
+        # Burst of failures is a single congestion event
+        for _ in range(3):
+            adaptive.record("example.com", False, now=200)
+
+        self.assertEqual(adaptive.window, grown // 2)
+
+        # Host window ignores one stalled page, but not slow host
+        adaptive = AdaptiveConcurrency(initial=4, host_initial=4,
+                                       host_maximum=8)
+        for num in range(40):
+            latency = 3 if num == 20 else 0.1
+            adaptive.record("example.com", True, latency, now=300 + num * 0.1)
+
+        grown = adaptive.limit("example.com")
+        self.assertEqual(grown, 8)
+
+        for num in range(40):
+            adaptive.record("example.com", True, 1, now=310 + num * 0.1)
+
+        self.assertTrue(adaptive.limit("example.com") < grown)
+        self.assertTrue(adaptive.window > grown)
+
+
+class FetchManyAdaptive(LocalSiteCase):
+    def runTest(self):
+        for name, adaptive in (("global", True),
+                               ("host", {"host_initial": 10})):
+            browser = Browser(cache_method="never",
+                              adaptive_concurrency=adaptive)
+
+            # Mix of fast and slow pages and one stalled page isn't
+            # congestion
+            urls = [{"url": "%s/slow/%s?%s" % (self.base, num % 2 * 0.2, num)}
+                    for num in range(300)]
+            urls.append({"url": "%s/stall/%s" % (self.base, name)})
+
+            started = time.time()
+            entries = browser.multi_fetch(urls, num_conn=50)
+
+            self.assertEqual(len(entries), 301)
+            self.assertTrue(time.time() - started < 8)
+            self.assertTrue(browser.adaptive_concurrency.window >= 10)
+
+
+class ResolverCheck(unittest.TestCase):
+    def runTest(self):
+        resolver = Resolver(negative_ttl=60)
+        addresses = resolver.resolve(["localhost", "no-such-host.invalid"])
+
+        self.assertEqual(addresses["localhost"], "127.0.0.1")
+        self.assertEqual(addresses["no-such-host.invalid"], None)
+
+        # Dead host is remembered
+        self.assertEqual(resolver.cache["no-such-host.invalid"][0], None)
+
+
+class TransferFilterCheck(unittest.TestCase):
+    def runTest(self):
+        rules = TransferFilter(content_types=["text/html", "text/xml"],
+                               codes=[200], max_length=1000)
+
+        self.assertEqual(rules.check_code(200), None)
+        self.assertEqual(rules.check_code(404), "code 404")
+
+        self.assertEqual(rules.check_header("Content-Type",
+                                            "text/html; charset=utf-8"), None)
+        self.assertEqual(rules.check_header("content-type", "application/pdf"),
+                         "content type application/pdf")
+
+        self.assertEqual(rules.check_header("Content-Length", "999"), None)
+        self.assertEqual(rules.check_header("Content-Length", "5000"),
+                         "length 5000")
+        self.assertEqual(rules.check_size(1001), "length 1001")
+
+        # Nothing is checked by default
+        self.assertEqual(TransferFilter().check_header("Content-Type",
+                                                       "image/png"), None)
+
+
+class FetchManyFiltered(LocalSiteCase):
+    def runTest(self):
+        config = {
+            "cache_method": "forever",
+            "cache_root": tempfile.mkdtemp(),
+            "retry": {"attempts": 3, "backoff": 0.01}
+        }
+
+        browser = Browser(**config)
+        html = self.base + "/item/1/1"
+        busy = self.base + "/flaky/filtered/5"
+        large = self.base + "/gzip/20000/unsized"
+        requests = [
+            {"url": html, "filter": {"content_types": ["application/json"]}},
+            {"url": busy, "filter": {"codes": [200]}},
+            {"url": large, "filter": {"max_length": 20000}}]
+
+        for _ in range(2):
+            entries = browser.multi_fetch(requests)
+
+            self.assertEqual(entries[html].reason, "content type text/html")
+            self.assertEqual(entries[busy].reason, "code 503")
+            # No Content-Length is sent, bytes are counted while they
+            # arrive and transfer is aborted within one write past limit
+            self.assertTrue(entries[large].reason.startswith("length "))
+            self.assertTrue(int(entries[large].reason.split()[1]) <
+                            20000 + 16384)
+
+            for entry in entries.values():
+                self.assertEqual(entry.result, "skipped")
+                self.assertEqual(entry.source, "web")
+                self.assertEqual(entry.data, None)
+                self.assertEqual(entry.attempts, 1)
+
+        # Skipped responses are neither retried nor cached
+        self.assertEqual(self.server.hits["/item/1/1"], 2)
+        self.assertEqual(self.server.hits["/flaky/filtered/5"], 2)
+        self.assertEqual(self.server.hits["/gzip/20000/unsized"], 2)
+
+
+class JournalCheck(unittest.TestCase):
+    def runTest(self):
+        path = os.path.join(tempfile.mkdtemp(), "journal")
+        journal = Journal(path)
+        journal.record(Struct(ids=[1, None], url="http://a/", result="ok",
+                              key=("GET", "http://a/", None, None)))
+        journal.record(Struct(ids=[2], url="http://b/", result="error",
+                              key=("GET", "http://b/", None, None)))
+        journal.close()
+
+        # Partially written line left by crash is ignored
+        with open(path, "a") as journal_file:
+            journal_file.write('{"key": 3, "res')
+
+        journal = Journal(path)
+        self.assertTrue(journal.is_finished(1, None))
+        self.assertTrue(journal.is_finished(None,
+                                            ("GET", "http://a/", None, None)))
+        self.assertFalse(journal.is_finished(2, None))
+        self.assertFalse(journal.is_finished(3, None))
+
+        # Records after the partial line are not glued to it
+        journal.record(Struct(ids=[3], url="http://c/", result="ok",
+                              key=("GET", "http://c/", None, None)))
+        journal.close()
+
+        journal = Journal(path, retry_errors=False)
+        self.assertTrue(journal.is_finished(2, None))
+        self.assertTrue(journal.is_finished(3, None))
+        journal.close()
+
+        with open(path) as journal_file:
+            self.assertEqual(len(journal_file.readlines()), 4)
+
+
+class ProxyPoolCheck(unittest.TestCase):
+    def runTest(self):
+        pool = ProxyPool(["http://a:1", "http://b:1"], max_connections=1,
+                         failures=2, cooldown=10)
+        first, second = pool.proxies
+
+        # Busy proxy is not given out, failed one is avoided on retry
+        self.assertTrue(pool.acquire(now=100) is first)
+        self.assertTrue(pool.acquire(now=100) is second)
+        self.assertEqual(pool.acquire(now=100), None)
+        pool.release(second, True, 0.5, now=100)
+        self.assertTrue(pool.acquire(exclude=first, now=100) is second)
+        pool.release(second, True, 0.5, now=100)
+
+        # Two failures in a row send proxy to rest
+        pool.release(first, False, now=100)
+        self.assertTrue(pool.acquire(first, now=100) is second)
+        pool.release(second, True, 0.5, now=100)
+        self.assertTrue(pool.acquire(second, now=100) is first)
+        pool.release(first, False, now=100)
+        self.assertEqual(pool.wakeup(now=100), 110)
+        self.assertTrue(pool.acquire(second, now=105) is second)
+        pool.release(second, now=105)
+        self.assertTrue(pool.acquire(second, now=111) is first)
+
+        # Only errors of proxy itself count, not of target site behind it
+        self.assertTrue(pool.is_failure(errno=pycurl.E_COULDNT_RESOLVE_PROXY))
+        self.assertTrue(pool.is_failure(errno=pycurl.E_COULDNT_CONNECT,
+                                        connected=False))
+        self.assertTrue(pool.is_failure(errno=pycurl.E_OPERATION_TIMEOUTED,
+                                        connected=False))
+        self.assertFalse(pool.is_failure(errno=pycurl.E_OPERATION_TIMEOUTED))
+        self.assertFalse(pool.is_failure(errno=pycurl.E_GOT_NOTHING))
+        self.assertFalse(pool.is_failure(errno=pycurl.E_RECV_ERROR))
+        self.assertTrue(pool.is_failure(code=407))
+        self.assertFalse(pool.is_failure(code=429))
+        self.assertFalse(pool.is_failure(code=404))
+
+
+class StandInProxy(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers every request itself with requested url as body, urls
+    with "/slow" are answered after a while"""
+    def do_GET(self):
+        if "/slow" in self.path:
+            time.sleep(1.5)
+
+        body = "proxied %s" % self.path
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchThroughProxies(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer(StandInProxy)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        # Nothing listens on port of closed socket
+        dead = socket.socket()
+        dead.bind(("127.0.0.1", 0))
+        self.dead_port = dead.getsockname()[1]
+        dead.close()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def runTest(self):
+        config = {
+            "cache_method": "never",
+            "proxies": {
+                "proxies": ["http://127.0.0.1:%s" % self.dead_port,
+                            "http://127.0.0.1:%s" % self.server.server_port],
+                "failures": 1
+            }
+        }
+
+        browser = Browser(**config)
+        urls = [{"url": "http://example.invalid/%s" % num, "id": num}
+                for num in range(10)]
+
+        entries = browser.multi_fetch(urls, num_conn=5)
+
+        self.assertEqual(len(entries), 10)
+        for url, entry in entries.items():
+            self.assertEqual(entry.result, "ok")
+            self.assertEqual(entry.data, "proxied %s" % url)
+
+        dead, alive = browser.proxies.proxies
+        self.assertTrue(dead.resting_until > 0)
+        self.assertEqual(dead.active + alive.active, 0)
+
+        data = browser.fetch("http://example.invalid/single")
+        self.assertEqual(data.data, "proxied http://example.invalid/single")
+
+        # Slow target site doesn't send connected proxy to rest
+        config["proxies"]["proxies"] = config["proxies"]["proxies"][1:]
+        config["transfer_timeout"] = 1
+        browser = Browser(**config)
+
+        entries = browser.multi_fetch([{"url": "http://example.invalid/slow"}])
+        self.assertEqual(entries["http://example.invalid/slow"].result,
+                         "error")
+        self.assertEqual(browser.proxies.proxies[0].resting_until, 0)
+
+
+@unittest.skipUnless(os.environ.get("CURLBROWSER_H2C_URL"),
+                     "set CURLBROWSER_H2C_URL to local h2c server url")
+class FetchManyHttp2(unittest.TestCase):
+    def runTest(self):
+        config = {
+            "cache_method": "never",
+            "http2": "prior_knowledge",
+            "max_host_connections": 1
+        }
+
+        browser = Browser(**config)
+
+        base = os.environ["CURLBROWSER_H2C_URL"]
+        urls = [{"url": "%s?page=%s" % (base, num), "id": num}
+                for num in range(50)]
+
+        entries = browser.multi_fetch(urls, num_conn=50)
+
+        self.assertEqual(len(entries), 50)
+        for entry in entries.values():
+            self.assertEqual(entry.result, "ok")
+
+
 if __name__ == '__main__':
     unittest.main()        
\ No newline at end of file
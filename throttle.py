@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""Request, bandwidth and concurrency limits used by Browser.multi_fetch
+scheduler"""
+
+import time
+
+
+class TokenBucket(object):
+    """Classic token bucket, 'rate' tokens are added every second but
+    no more than 'burst' tokens can be stored.
+
+    Bucket can go below zero when more is consumed than available
+    (for example, page turned out to be bigger than expected), such
+    debt delays next consumers until it's paid off
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.stamp = time.time()
+
+    def __refill(self, now):
+        """Add tokens for time passed since last call"""
+        if now > self.stamp:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def delay(self, amount=1, now=None):
+        """Seconds to wait until 'amount' tokens are available"""
+        self.__refill(now or time.time())
+
+        # Never ask for more than bucket can hold, or we will wait forever
+        amount = min(amount, self.burst)
+        if self.tokens >= amount:
+            return 0
+
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount=1, now=None):
+        """Take tokens from bucket, going into debt if needed"""
+        self.__refill(now or time.time())
+        self.tokens -= amount
+
+
+class RateLimiter(object):
+    """Limits requests and bytes per second, globally and per host.
+
+    requests_per_second, bytes_per_second - global limits for all hosts
+
+    host_requests_per_second, host_bytes_per_second - limits applied to
+    every host separately
+
+    hosts - dict of per host overrides, like
+        {"example.com": {"requests_per_second": 2}}
+
+    burst - how many requests can be started at once after idle period,
+    default is 1 which spreads requests evenly
+
+    Bytes are charged after transfer is finished, so big page only delays
+    next requests and can't be throttled while downloading
+    """
+    def __init__(self, requests_per_second=None, bytes_per_second=None,
+                 host_requests_per_second=None, host_bytes_per_second=None,
+                 hosts=None, burst=1):
+        self.host_requests_per_second = host_requests_per_second
+        self.host_bytes_per_second = host_bytes_per_second
+        self.hosts = hosts or {}
+        self.burst = burst
+
+        self.global_buckets = self.__make_buckets(requests_per_second,
+                                                  bytes_per_second)
+        self.host_buckets = dict()
+
+    def __make_buckets(self, requests_per_second, bytes_per_second):
+        """Return (requests, bytes) pair of buckets, any of them can be None"""
+        requests = bytes_ = None
+        if requests_per_second:
+            requests = TokenBucket(requests_per_second, self.burst)
+        if bytes_per_second:
+            bytes_ = TokenBucket(bytes_per_second)
+
+        return requests, bytes_
+
+    def __get_buckets(self, host):
+        """Get buckets for host or global ones if host is None"""
+        if host is None:
+            return self.global_buckets
+
+        if host not in self.host_buckets:
+            config = self.hosts.get(host, {})
+            self.host_buckets[host] = self.__make_buckets(
+                config.get("requests_per_second",
+                           self.host_requests_per_second),
+                config.get("bytes_per_second", self.host_bytes_per_second))
+
+        return self.host_buckets[host]
+
+    def delay(self, host=None, now=None):
+        """Seconds to wait before next request to 'host' can be started,
+        global limits are checked when host is None"""
+        now = now or time.time()
+        delays = [bucket.delay(now=now) for bucket in self.__get_buckets(host)
+                  if bucket is not None]
+
+        return max(delays or [0])
+
+    def consume(self, host, now=None):
+        """Register started request"""
+        now = now or time.time()
+        for buckets in (self.global_buckets, self.__get_buckets(host)):
+            if buckets[0] is not None:
+                buckets[0].consume(now=now)
+
+    def charge(self, host, size, now=None):
+        """Register 'size' bytes downloaded from host"""
+        now = now or time.time()
+        for buckets in (self.global_buckets, self.__get_buckets(host)):
+            if buckets[1] is not None:
+                buckets[1].consume(size, now=now)
+
+
+# Times to first byte are rounded up to this many seconds, differences
+# below it are noise of scheduling rather than congestion
+LATENCY_RESOLUTION = 0.01
+
+# Transfers finished in one round are never less than this, so window
+# of one or two connections still sees a few samples per decision
+ROUND_MINIMUM = 8
+
+
+class ConcurrencyWindow(object):
+    """Number of simultaneous connections controlled by additive increase,
+    multiplicative decrease rule: window grows by one connection for every
+    successful transfer until the first congestion, then by one for every
+    window worth of them, and is cut by 'decrease' factor on congestion.
+    It only grows while it's filled.
+
+    Round lasts for 'interval' seconds and two round trips at least, and
+    until a window worth of transfers is finished. Window with
+    'check_latency' (one of a host) is congested when the fastest time to
+    first byte of a round is inflated over the best one of this host,
+    other window (global one) when throughput of a round falls much below
+    the best one reached with smaller window. Both are congested on high
+    error rate
+    """
+    def __init__(self, initial, minimum, maximum, check_latency=False):
+        self.size = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.check_latency = check_latency
+        self.slow_start = True
+        self.latency = None
+        self.base_latency = None
+        self.throughput = None
+        self.throughput_size = None
+        self.errors = 0.0
+        self.last_decrease = 0
+        self.last_update = None
+        self.round_start = None
+        self.round_finished = 0
+        self.round_ok = 0
+        self.round_latency = None
+
+    def limit(self):
+        """Current window size as number of connections"""
+        return max(self.minimum, int(self.size))
+
+    def __start_round(self, now):
+        """Forget samples of previous round"""
+        self.round_start = now
+        self.round_finished = self.round_ok = 0
+        self.round_latency = None
+
+    def __round_congested(self, controller, now):
+        """Check samples of finished round for congestion"""
+        if self.check_latency:
+            if self.round_latency is None:
+                return False
+
+            latency = max(self.round_latency, LATENCY_RESOLUTION)
+            # Let base latency slowly go up, so permanent change of
+            # server response time isn't treated as congestion forever
+            self.base_latency = latency if self.base_latency is None \
+                else min(latency, self.base_latency * 1.01)
+
+            return latency > self.base_latency * controller.latency_factor
+
+        if now <= self.round_start:
+            return False
+
+        throughput = self.round_ok / (now - self.round_start)
+        if self.throughput is not None:
+            self.throughput *= 0.99
+
+        if self.throughput is None or throughput >= self.throughput:
+            self.throughput = throughput
+            self.throughput_size = self.size
+            return False
+
+        # More connections than at best round gave much less pages
+        return self.size >= self.throughput_size and \
+            throughput < self.throughput * controller.throughput_drop
+
+    def update(self, ok, latency, controller, now, active=None):
+        """Adjust window size using transfer outcome, 'active' is number of
+        transfers running when this one finished"""
+        smoothing = controller.smoothing
+        self.errors = self.errors * (1 - smoothing) + (not ok) * smoothing
+
+        if ok and latency:
+            self.latency = latency if self.latency is None \
+                else self.latency * (1 - smoothing) + latency * smoothing
+            self.round_latency = latency if self.round_latency is None \
+                else min(self.round_latency, latency)
+
+        # Idle time between multi_fetch calls isn't a part of any round
+        if self.last_update is None or \
+           now - self.last_update > max(1, (self.latency or 0) * 10):
+            self.__start_round(now)
+        self.last_update = now
+
+        self.round_finished += 1
+        self.round_ok += ok
+
+        congested = self.errors > controller.error_rate
+        if self.round_finished >= max(self.limit(), ROUND_MINIMUM) and \
+           now - self.round_start >= max(controller.interval,
+                                         (self.latency or 0) * 2):
+            congested = self.__round_congested(controller, now) or congested
+            self.__start_round(now)
+
+        if congested:
+            # Only one decrease per round trip, otherwise burst of
+            # failures started at the same time would collapse window
+            if now - self.last_decrease > (self.latency or 1):
+                self.size = max(self.minimum, self.size * controller.decrease)
+                self.last_decrease = now
+                self.slow_start = False
+        elif ok and (active is None or active >= self.limit()):
+            # Window which isn't filled doesn't tell if it's big enough
+            self.size = min(self.maximum, self.size +
+                            (1.0 if self.slow_start else 1.0 / self.size))
+
+
+class AdaptiveConcurrency(object):
+    """Picks number of simultaneous connections for multi_fetch instead of
+    fixed 'num_conn', which is used as upper bound then.
+
+    initial, minimum, maximum - global window bounds
+
+    host_initial, host_maximum - enables separate window for every host
+
+    latency_factor - host is considered congested when the fastest time
+    to first byte of a round gets this much bigger than best one observed
+    for this host, used only by per host windows
+
+    throughput_drop - global window is considered congested when
+    transfers finished per second in a round fall below this share of the
+    best round reached with smaller window
+
+    error_rate - smoothed share of failed transfers (errors, timeouts, 429
+    and 5xx responses) considered as congestion
+
+    decrease - factor window is multiplied by on congestion
+
+    interval - shortest time latency and throughput are measured over
+    before window is checked for congestion, pages finish in bursts and
+    shorter periods would mistake them for changes of throughput
+
+    Object keeps it's state between multi_fetch calls, so same Browser
+    instance learns capacity of network and servers over time
+    """
+    def __init__(self, initial=10, minimum=1, maximum=1024, host_initial=None,
+                 host_maximum=None, latency_factor=3.0, throughput_drop=0.5,
+                 error_rate=0.2, decrease=0.5, interval=1.0, smoothing=0.1):
+        self.latency_factor = latency_factor
+        self.interval = interval
+        self.throughput_drop = throughput_drop
+        self.error_rate = error_rate
+        self.decrease = decrease
+        self.smoothing = smoothing
+        self.host_initial = host_initial
+        self.host_maximum = host_maximum or maximum
+
+        self.global_window = ConcurrencyWindow(initial, minimum, maximum)
+        self.host_windows = dict()
+
+    @property
+    def window(self):
+        """Current global window size"""
+        return self.global_window.limit()
+
+    def limit(self, host=None):
+        """Maximum number of connections allowed for host, or global one if
+        host is None"""
+        if host is None:
+            return self.global_window.limit()
+
+        if not self.host_initial:
+            return self.global_window.maximum
+
+        if host not in self.host_windows:
+            self.host_windows[host] = ConcurrencyWindow(
+                self.host_initial, self.global_window.minimum,
+                self.host_maximum, check_latency=True)
+
+        return self.host_windows[host].limit()
+
+    def record(self, host, ok, latency=None, now=None, active=None,
+               host_active=None):
+        """Register finished transfer, 'active' and 'host_active' are
+        numbers of all transfers and of transfers to this host running
+        when it finished, including itself. Windows grow only when they
+        are filled"""
+        now = now or time.time()
+        self.global_window.update(ok, latency, self, now, active)
+
+        if self.host_initial:
+            self.limit(host)
+            self.host_windows[host].update(ok, latency, self, now,
+                                           host_active)